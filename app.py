@@ -2,12 +2,13 @@ import streamlit as st
 # from openai import OpenAI
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
-from summary import generate_pdf_summary_prompt
-from citation import generate_pdf_citation_prompt
-from upload import upload_pdf
+from summary import stream_pdf_summary
+from citation import generate_pdf_citation
+from upload import upload_pdfs
 # from rag import generate_rag_runnable_chain
 from function_tools import get_fosrc_answer
 import os
+import asyncio
 from dotenv import load_dotenv
 
 if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
@@ -57,10 +58,12 @@ def summarize_pdf():
 
         with st.spinner("Processing"):
 
-            response = get_open_ai_client().invoke([SystemMessage(generate_pdf_summary_prompt(uploaded_pdf_file, selected_language))])
+            # Display the summary as it streams; long documents are
+            # summarized section by section before the final summary streams
+            streaming_response_text = st.write_stream(stream_pdf_summary(uploaded_pdf_file, selected_language, get_open_ai_client()))
 
             # Append the assistant's full response to the 'messages' list
-            st.session_state.messages.append({"role": "assistant", "content": response.content})
+            st.session_state.messages.append({"role": "assistant", "content": streaming_response_text})
 
             st.rerun()
 
@@ -86,10 +89,12 @@ def generate_citation():
 
         with st.spinner("Processing"):
 
-            response = get_open_ai_client().invoke([SystemMessage(generate_pdf_citation_prompt(uploaded_pdf_file, selected_citation_style))])
+            # The citation is rendered from the PDF metadata when it is
+            # complete, and is otherwise generated by the model
+            citation = generate_pdf_citation(uploaded_pdf_file, selected_citation_style, get_open_ai_client())
 
             # Append the assistant's full response to the 'messages' list
-            st.session_state.messages.append({"role": "assistant", "content": response.content})
+            st.session_state.messages.append({"role": "assistant", "content": citation})
 
             st.rerun()
 
@@ -113,12 +118,30 @@ def upload():
 
         with st.spinner("Processing"):
 
-            for file in uploaded_pdf_files:
-                response = get_open_ai_client().invoke([SystemMessage(generate_pdf_citation_prompt(file, "APA"))])
-                upload_pdf(file, response.content)
+            # Show the progress of every file as the files are cited and
+            # uploaded concurrently
+            file_status_placeholders = {id(file): st.empty() for file in uploaded_pdf_files}
+
+            status_messages = {
+                "citing": "Generating citation",
+                "uploading": "Uploading",
+                "done": "Done",
+                "failed": "Failed",
+            }
+
+            def show_file_progress(file, status, error):
+                status_message = f"{file.name}: {status_messages[status]}"
+                if error is not None:
+                    status_message += f" ({error})"
+                file_status_placeholders[id(file)].write(status_message)
+
+            failed_count = asyncio.run(upload_pdfs(uploaded_pdf_files, get_open_ai_client(), on_progress=show_file_progress))
 
             # Append the assistant's full response to the 'messages' list
-            st.session_state.messages.append({"role": "assistant", "content": "Upload to vector database complete."})
+            if failed_count:
+                st.session_state.messages.append({"role": "assistant", "content": f"Upload to vector database complete.  {failed_count} of {len(uploaded_pdf_files)} file(s) failed to upload."})
+            else:
+                st.session_state.messages.append({"role": "assistant", "content": "Upload to vector database complete."})
 
             st.rerun()
 
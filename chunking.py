@@ -0,0 +1,198 @@
+from itertools import islice
+import numpy as np
+import tiktoken
+import re
+import os
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+gpt_model = os.getenv("GPT_MODEL")
+
+# Token budget and token overlap of the chunks of every source type: the
+# uploaded PDFs, the scraped web pages, and the items (metadata and PDFs)
+# ingested from the DSpace REST API
+chunk_settings = {
+    "pdf": {
+        "chunk_tokens": int(os.getenv("CHUNK_TOKENS_PDF", "256")),
+        "overlap_tokens": int(os.getenv("CHUNK_OVERLAP_TOKENS_PDF", "32")),
+    },
+    "web": {
+        "chunk_tokens": int(os.getenv("CHUNK_TOKENS_WEB", "512")),
+        "overlap_tokens": int(os.getenv("CHUNK_OVERLAP_TOKENS_WEB", "32")),
+    },
+    "dspace": {
+        "chunk_tokens": int(os.getenv("CHUNK_TOKENS_DSPACE", "256")),
+        "overlap_tokens": int(os.getenv("CHUNK_OVERLAP_TOKENS_DSPACE", "32")),
+    },
+}
+
+# Sentences end before the whitespace that follows a ".", "!" or "?", and
+# before every new line; the whitespace stays at the start of the next
+# sentence, where the tokenizer attaches it to the first word, so the token
+# count of a chunk is the sum of the token counts of its sentences
+sentence_boundary_pattern = re.compile(r"(?<=[.!?])(?=\s)|(?=\n)")
+
+# Minimum number of pending tokens before the complete chunks of a stream
+# of text pieces are yielded
+token_chunk_window_multiplier = 4
+
+_encoding = None
+
+def get_token_encoding():
+    global _encoding
+
+    # Use the tokenizer of the configured GPT model, falling back to the
+    # tokenizer of the GPT-4o model family for unknown model names
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(gpt_model or "gpt-4o-mini")
+        except KeyError:
+            _encoding = tiktoken.get_encoding("o200k_base")
+
+    return _encoding
+
+def count_tokens(text):
+    return len(get_token_encoding().encode(text, disallowed_special=()))
+
+def split_text_by_tokens(text, chunk_tokens):
+
+    # Splits the text into pieces of at most chunk_tokens tokens each
+    encoding = get_token_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+
+    return [encoding.decode(tokens[i:i + chunk_tokens]) for i in range(0, len(tokens), chunk_tokens)]
+
+def get_chunk_settings(source_type):
+    if source_type not in chunk_settings:
+        raise ValueError(f"Unknown chunk source type {source_type}; the source types are: {', '.join(chunk_settings)}")
+    return chunk_settings[source_type]
+
+def get_chunking_signature(source_type):
+
+    # Identifies the chunking of the source type, so that the ingested text
+    # can be chunked again when the chunk settings change
+    settings = get_chunk_settings(source_type)
+    return f"tokens:{settings['chunk_tokens']}:{settings['overlap_tokens']}"
+
+def split_sentences(text):
+    return [sentence for sentence in sentence_boundary_pattern.split(text) if sentence]
+
+def _get_sentence_tokens(sentences, chunk_tokens):
+
+    # Counts the tokens of all the sentences with one batch encoding, and
+    # splits the sentences longer than the token budget into pieces of at
+    # most chunk_tokens tokens
+    encoding = get_token_encoding()
+    sentence_tokens = encoding.encode_ordinary_batch(sentences)
+
+    split_sentences = []
+    token_counts = []
+    for sentence, tokens in zip(sentences, sentence_tokens):
+        if len(tokens) <= chunk_tokens:
+            split_sentences.append(sentence)
+            token_counts.append(len(tokens))
+            continue
+
+        for i in range(0, len(tokens), chunk_tokens):
+            split_sentences.append(encoding.decode(tokens[i:i + chunk_tokens]))
+            token_counts.append(len(tokens[i:i + chunk_tokens]))
+
+    return split_sentences, np.asarray(token_counts, dtype=np.int64)
+
+def _find_chunk_boundaries(token_counts, chunk_tokens, overlap_tokens, is_final):
+
+    # Returns the (start, stop) sentence ranges of the chunks, and the first
+    # sentence that is not part of a complete chunk yet; with the cumulative
+    # token counts, the end of every chunk (the most sentences that fit in
+    # the token budget) and the start of the next one (the trailing sentences
+    # that fit in the overlap) are found with binary searches
+    cumulative_tokens = np.concatenate(([0], np.cumsum(token_counts)))
+    sentence_count = len(token_counts)
+
+    boundaries = []
+    start = 0
+    while start < sentence_count:
+        stop = int(np.searchsorted(cumulative_tokens, cumulative_tokens[start] + chunk_tokens, side="right")) - 1
+        stop = max(stop, start + 1)
+
+        # The last chunk of a stream may still grow with the next text piece
+        if stop == sentence_count and not is_final:
+            break
+
+        boundaries.append((start, stop))
+        if stop == sentence_count:
+            start = stop
+            break
+
+        # The overlap sentences must leave room for the next sentence
+        next_start = int(np.searchsorted(cumulative_tokens, cumulative_tokens[stop] - overlap_tokens, side="left"))
+        next_start = max(next_start, int(np.searchsorted(cumulative_tokens, cumulative_tokens[stop + 1] - chunk_tokens, side="left")))
+        start = min(max(next_start, start + 1), stop)
+
+    return boundaries, start
+
+def iter_token_chunks(texts, source_type):
+
+    # Splits a stream of text pieces (e.g. PDF pages) into chunks of whole
+    # sentences of at most the token budget of the source type, with up to
+    # the overlap tokens of trailing sentences repeated at the start of the
+    # next chunk; the chunks are yielded as soon as they are complete
+    settings = get_chunk_settings(source_type)
+    chunk_tokens = settings["chunk_tokens"]
+    overlap_tokens = min(settings["overlap_tokens"], chunk_tokens - 1)
+
+    pending_sentences = []
+    pending_token_counts = np.empty(0, dtype=np.int64)
+    carry_over = ""
+
+    def pack(is_final):
+        nonlocal pending_sentences, pending_token_counts
+
+        boundaries, next_start = _find_chunk_boundaries(pending_token_counts, chunk_tokens, overlap_tokens, is_final)
+        chunks = [chunk for chunk in ("".join(pending_sentences[start:stop]).strip() for start, stop in boundaries) if chunk]
+
+        pending_sentences = pending_sentences[next_start:]
+        pending_token_counts = pending_token_counts[next_start:]
+
+        return chunks
+
+    for text in texts:
+
+        # The last sentence of a text piece may continue in the next piece
+        sentences = split_sentences(carry_over + text)
+        carry_over = sentences.pop() if sentences else ""
+
+        # A long run of text without sentence boundaries (a table, or text
+        # extracted without punctuation) is flushed in pieces of the token
+        # budget, instead of growing and being split again with every piece
+        if len(carry_over) > chunk_tokens:
+            carry_over_pieces, _ = _get_sentence_tokens([carry_over], chunk_tokens)
+            carry_over = carry_over_pieces.pop()
+            sentences.extend(carry_over_pieces)
+
+        if not sentences:
+            continue
+
+        sentences, token_counts = _get_sentence_tokens(sentences, chunk_tokens)
+        pending_sentences.extend(sentences)
+        pending_token_counts = np.concatenate((pending_token_counts, token_counts))
+
+        if pending_token_counts.sum() >= token_chunk_window_multiplier * chunk_tokens:
+            yield from pack(is_final=False)
+
+    if carry_over:
+        sentences, token_counts = _get_sentence_tokens([carry_over], chunk_tokens)
+        pending_sentences.extend(sentences)
+        pending_token_counts = np.concatenate((pending_token_counts, token_counts))
+
+    yield from pack(is_final=True)
+
+def iter_batches(items, batch_size):
+
+    # Groups a stream of items into lists of at most batch_size items
+    iterator = iter(items)
+
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
@@ -1,15 +1,61 @@
 from pypdf import PdfReader
+from langchain_core.messages import SystemMessage
+from pdf_text import get_pdf_text, read_pdf_bytes
+import asyncio
+import io
+import re
+import os
+from dotenv import load_dotenv
 
-def generate_pdf_citation_prompt(pdf_file, citation_style):
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# When enabled, citations are rendered locally from the PDF metadata
+# whenever the metadata has a title, authors and a year, and the model
+# is only asked for a citation when some of those fields are missing
+citation_metadata_fast_path = os.getenv("CITATION_METADATA_FAST_PATH", "true").lower() == "true"
+
+doi_pattern = re.compile(r'\b(10\.\d{4,9}/[-._;()/:A-Za-z0-9]+[A-Za-z0-9])')
+year_pattern = re.compile(r'\b(1[89]\d{2}|20\d{2})\b')
+
+# PRISM namespaces (publication date of the published version) found in the
+# XMP metadata of journal articles
+prism_namespaces = [
+    "http://prismstandard.org/namespaces/basic/3.0/",
+    "http://prismstandard.org/namespaces/basic/2.1/",
+    "http://prismstandard.org/namespaces/basic/2.0/",
+    "http://prismstandard.org/namespaces/1.2/basic/",
+]
 
-    pdf_reader = PdfReader(pdf_file)
+# Placeholder titles and authors written by authoring tools rather than people
+placeholder_titles = {"untitled", "title", "document", "microsoft word"}
+placeholder_authors = {"admin", "administrator", "user", "owner", "author", "unknown"}
 
-    pdf_text = ""
+# Degrees and suffixes written after a name ("Jane Doe, Ph.D."), which make
+# the "Last, First" form ambiguous
+name_suffixes = {
+    "phd", "ph.d", "ph.d.", "md", "m.d.", "msc", "m.sc.", "bsc", "b.sc.", "ma", "m.a.", "ba", "b.a.", "mba", "dvm", "d.v.m.",
+    "peng", "p.eng.", "rpbio", "r.p.bio.", "jr", "jr.", "sr", "sr.", "ii", "iii", "iv",
+}
+
+# Lowercase particles of person names ("Ludwig van Beethoven")
+name_particles = {"van", "von", "der", "den", "de", "du", "da", "di", "la", "le", "del", "des", "dos", "st."}
+
+# Words of organization names, so that "Canadian Science Advisory
+# Secretariat" is not taken for the name of a person
+corporate_author_words = {
+    "agency", "association", "board", "branch", "bureau", "canada", "centre", "center", "college", "commission",
+    "committee", "council", "department", "directorate", "division", "fisheries", "foundation", "government",
+    "group", "institute", "laboratory", "ministry", "network", "oceans", "office", "program", "programme",
+    "region", "research", "secretariat", "service", "services", "society", "station", "survey", "university",
+    "gouvernement", "ministère", "pêches", "océans", "secrétariat", "direction",
+}
+
+def generate_pdf_citation_prompt(pdf_file, citation_style):
 
-    # Only read the first PDF page and remove all the new 
-    # line characters to save tokens
-    for i in range(1):
-        pdf_text += ' '.join(pdf_reader.pages[i].extract_text().split())
+    # Only read the first PDF page with the new line
+    # characters removed to save tokens
+    pdf_text = get_pdf_text(pdf_file, max_pages=1)
 
     citation_prompt = f'''
 You are an expert at creating academic citations.  Create a {citation_style} citation for the following text, and only output the citation:
@@ -18,3 +64,297 @@ You are an expert at creating academic citations.  Create a {citation_style} cit
 
     return citation_prompt
 
+def _is_placeholder_title(title):
+    lowered_title = title.lower()
+    return (
+        len(title) < 4
+        or lowered_title in placeholder_titles
+        or lowered_title.startswith("microsoft word - ")
+        or lowered_title.endswith((".doc", ".docx", ".pdf", ".indd", ".tex"))
+    )
+
+def _is_capitalized_name(names):
+    return bool(names) and all(name[0].isupper() or name.lower() in name_particles for name in names)
+
+def _has_person_name_shape(author):
+
+    # "Last, First" or two to four capitalized names ("Jane Q. Doe"),
+    # without words of organization names
+    if "," in author:
+        last_name, first_names = author.split(",", 1)
+        return _is_capitalized_name(last_name.split()) and _is_capitalized_name(first_names.split())
+
+    names = author.split()
+    if not 2 <= len(names) <= 4:
+        return False
+    if any(name.lower() in corporate_author_words for name in names):
+        return False
+    return _is_capitalized_name(names)
+
+def is_unambiguous_author(author):
+
+    # An author is only rendered locally when its form is certain: at most
+    # one comma, which separates the last name from the first names ("Doe,
+    # Jane", not "Doe, Jane and Smith, John" or "Smith, J., Doe, A."), and
+    # no degree or suffix ("Jane Doe, Ph.D.")
+    if any(name.lower().strip(",") in name_suffixes for name in author.split()):
+        return False
+    if author.count(",") > 1:
+        return False
+    if "," in author:
+        return not re.search(r'\s(?:and|&)\s|&', author) and _has_person_name_shape(author)
+    return True
+
+def is_corporate_author(author):
+
+    # An organization ("Fisheries and Oceans Canada") is cited verbatim
+    return "," not in author and not _has_person_name_shape(author)
+
+def _split_authors(author_text):
+
+    # Authors are separated by ";", or listed as "A, B and C" (or "A and B")
+    # when every listed part is the name of a person; anything else is one
+    # author, so that organization names containing "and" stay whole
+    if ";" in author_text:
+        parts = author_text.split(";")
+    else:
+        parts = [author_text]
+        list_parts = [part.strip() for part in re.split(r',\s*(?:and\s+|&\s*)?|\s+and\s+|\s*&\s*', author_text) if part.strip()]
+        if len(list_parts) > 1 and re.search(r'\s(?:and|&)\s', author_text) and all(_has_person_name_shape(part) for part in list_parts):
+            parts = list_parts
+
+    # An empty list (the model is asked for the citation) is returned when
+    # any author is ambiguous
+    authors = []
+    for part in parts:
+        author = ' '.join(part.split()).strip(" ,")
+        if not author or author.lower() in placeholder_authors:
+            continue
+
+        # A single word ("jdoe", "DFO") is usually an account name rather
+        # than the author
+        if len(author.split()) < 2 or not is_unambiguous_author(author):
+            return []
+
+        authors.append(author)
+
+    return authors
+
+def _split_author_name(author):
+
+    # Returns the (last name, first names) of an author written either as
+    # "Last, First Middle" or as "First Middle Last"
+    if "," in author:
+        last_name, first_names = author.split(",", 1)
+        return last_name.strip(), first_names.strip()
+
+    names = author.split()
+    return names[-1], " ".join(names[:-1])
+
+def _get_initials(first_names):
+    initials = []
+    for name in first_names.replace(".", ". ").split():
+        initials.append("-".join(part[0] + "." for part in name.split("-") if part))
+    return " ".join(initials)
+
+def _read_year(value):
+    if value is None:
+        return None
+    if hasattr(value, "year"):
+        return str(value.year)
+    year_match = year_pattern.search(str(value))
+    return year_match.group(1) if year_match else None
+
+def _read_xmp_text(xmp_metadata, namespace, name):
+    for node in xmp_metadata.get_element("", namespace, name):
+        if node.nodeType == node.ATTRIBUTE_NODE:
+            return node.value
+
+        text_nodes = []
+        stack = [node]
+        while stack:
+            child = stack.pop()
+            if child.nodeType == child.TEXT_NODE:
+                text_nodes.append(child.data)
+            stack.extend(reversed(child.childNodes))
+        return "".join(text_nodes).strip() or None
+
+    return None
+
+def extract_pdf_citation_metadata(pdf_file):
+
+    # Reads the title, authors, year and DOI from the PDF XMP metadata, the
+    # PDF document information dictionary, and the text of the first page
+    pdf_reader = PdfReader(io.BytesIO(read_pdf_bytes(pdf_file)))
+
+    title = None
+    authors = []
+    year = None
+    doi = None
+
+    try:
+        xmp_metadata = pdf_reader.xmp_metadata
+    except Exception:
+        xmp_metadata = None
+
+    if xmp_metadata is not None:
+        try:
+            if xmp_metadata.dc_title:
+                title = xmp_metadata.dc_title.get("x-default") or next(iter(xmp_metadata.dc_title.values()), None)
+            if xmp_metadata.dc_creator:
+                creator_authors = [_split_authors(creator) for creator in xmp_metadata.dc_creator]
+                if all(creator_authors):
+                    authors = [author for authors_of_creator in creator_authors for author in authors_of_creator]
+            if xmp_metadata.dc_date:
+                year = _read_year(xmp_metadata.dc_date[0])
+            for prism_namespace in prism_namespaces:
+                if year:
+                    break
+                year = _read_year(_read_xmp_text(xmp_metadata, prism_namespace, "publicationDate"))
+            if xmp_metadata.dc_identifier:
+                doi_match = doi_pattern.search(" ".join(xmp_metadata.dc_identifier))
+                doi = doi_match.group(1) if doi_match else None
+        except Exception as e:
+            print(f"Could not read the PDF XMP metadata: {e}")
+
+    try:
+        document_info = pdf_reader.metadata
+    except Exception:
+        document_info = None
+
+    if document_info is not None:
+        if not title and document_info.title:
+            title = str(document_info.title)
+        if not authors and document_info.author:
+            authors = _split_authors(str(document_info.author))
+        if not doi:
+            for key in ("/doi", "/DOI", "/Subject", "/Keywords"):
+                doi_match = doi_pattern.search(str(document_info.get(key) or ""))
+                if doi_match:
+                    doi = doi_match.group(1)
+                    break
+
+    # The year is only read from the XMP publication dates: the creation
+    # date of the document information dictionary is when the file was
+    # created or exported, and the years on the first page are as often
+    # data, copyright or "received" years as the publication year
+    if not doi:
+        doi_match = doi_pattern.search(get_pdf_text(pdf_file, max_pages=1))
+        doi = doi_match.group(1) if doi_match else None
+
+    if title:
+        title = ' '.join(title.split())
+        if _is_placeholder_title(title):
+            title = None
+
+    return {
+        "title": title,
+        "authors": authors,
+        "year": year,
+        "doi": doi,
+    }
+
+def _format_apa_authors(authors):
+    formatted_authors = []
+    for author in authors:
+        if is_corporate_author(author):
+            formatted_authors.append(author)
+            continue
+        last_name, first_names = _split_author_name(author)
+        initials = _get_initials(first_names)
+        formatted_authors.append(f"{last_name}, {initials}" if initials else last_name)
+
+    # APA lists up to 20 authors, and replaces the rest (except
+    # the last author) with an ellipsis
+    if len(formatted_authors) == 1:
+        return formatted_authors[0]
+    if len(formatted_authors) > 20:
+        return ", ".join(formatted_authors[:19]) + ", . . . " + formatted_authors[-1]
+    return ", ".join(formatted_authors[:-1]) + ", & " + formatted_authors[-1]
+
+def _format_mla_authors(authors):
+    if is_corporate_author(authors[0]):
+        first_author = authors[0]
+    else:
+        last_name, first_names = _split_author_name(authors[0])
+        first_author = f"{last_name}, {first_names}" if first_names else last_name
+
+    if len(authors) == 1:
+        return first_author
+    if len(authors) == 2:
+        if is_corporate_author(authors[1]):
+            return f"{first_author}, and {authors[1]}"
+        last_name, first_names = _split_author_name(authors[1])
+        return f"{first_author}, and {first_names} {last_name}".replace("  ", " ")
+    return f"{first_author}, et al"
+
+def format_citation(citation_metadata, citation_style):
+
+    # Renders the citation from the metadata, or returns None when the
+    # metadata is missing the title, the authors, or the year, or when an
+    # author is ambiguous
+    title = citation_metadata.get("title")
+    authors = citation_metadata.get("authors")
+    year = citation_metadata.get("year")
+    doi = citation_metadata.get("doi")
+
+    if not title or not authors or not year:
+        return None
+
+    if not all(is_unambiguous_author(author) for author in authors):
+        return None
+
+    title = title.rstrip(".")
+    doi_link = f"https://doi.org/{doi}" if doi else ""
+
+    if citation_style == "APA":
+        apa_authors = _format_apa_authors(authors)
+        citation = f"{apa_authors}{'' if apa_authors.endswith('.') else '.'} ({year}). *{title}*."
+        return f"{citation} {doi_link}" if doi_link else citation
+
+    if citation_style == "MLA":
+        mla_authors = _format_mla_authors(authors)
+        citation = f"{mla_authors}{'' if mla_authors.endswith('.') else '.'} *{title}*. {year}"
+        return f"{citation}, {doi_link}." if doi_link else f"{citation}."
+
+    return None
+
+def generate_pdf_citation(pdf_file, citation_style, client):
+
+    # Render the citation locally when the PDF metadata is complete, and
+    # otherwise ask the model to create it from the first page
+    if citation_metadata_fast_path:
+        try:
+            citation = format_citation(extract_pdf_citation_metadata(pdf_file), citation_style)
+        except Exception as e:
+            print(f"Could not create the citation from the PDF metadata: {e}")
+            citation = None
+
+        if citation:
+            return citation
+
+    response = client.invoke([SystemMessage(generate_pdf_citation_prompt(pdf_file, citation_style))])
+
+    return response.content
+
+async def agenerate_pdf_citation(pdf_file, citation_style, client):
+
+    # Asynchronous version of generate_pdf_citation; the PDF is read in a
+    # worker thread, and the model is only awaited when the metadata is
+    # incomplete
+    if citation_metadata_fast_path:
+        try:
+            citation_metadata = await asyncio.to_thread(extract_pdf_citation_metadata, pdf_file)
+            citation = format_citation(citation_metadata, citation_style)
+        except Exception as e:
+            print(f"Could not create the citation from the PDF metadata: {e}")
+            citation = None
+
+        if citation:
+            return citation
+
+    citation_prompt = await asyncio.to_thread(generate_pdf_citation_prompt, pdf_file, citation_style)
+
+    response = await client.ainvoke([SystemMessage(citation_prompt)])
+
+    return response.content
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import os
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# The crawl ledger records every web page found in the sitemap, and what was
+# ingested for it, so that a re-run of the scraper only processes new or
+# changed web pages, and an interrupted run resumes where it stopped
+crawl_ledger_path = os.getenv("CRAWL_LEDGER_PATH", os.path.join(".cache", "crawl_ledger.sqlite3"))
+
+# Status of a web page in the ledger
+status_pending = "pending"
+status_done = "done"
+status_failed = "failed"
+status_removed = "removed"
+
+_crawl_ledger = None
+_crawl_ledger_lock = threading.Lock()
+
+def get_content_hash(title, text, chunking_signature=""):
+    return hashlib.sha256(f"{chunking_signature}\n{title}\n{text}".encode("utf-8")).hexdigest()
+
+class CrawlLedger:
+
+    def __init__(self, ledger_path):
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(ledger_path) or ".", exist_ok=True)
+
+        self._connection = sqlite3.connect(ledger_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+
+        # sitemap_lastmod is the last modification date found in the sitemap
+        # during the last run, and lastmod the date of the ingested version
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "url TEXT PRIMARY KEY, sitemap_lastmod TEXT, lastmod TEXT, content_hash TEXT, vector_ids TEXT NOT NULL DEFAULT '[]', "
+            "status TEXT NOT NULL, seen_run_id INTEGER, run_id INTEGER, updated_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, started_at REAL NOT NULL, finished_at REAL)")
+        self._connection.commit()
+
+    def begin_run(self):
+
+        # Resumes the last run when it did not finish, or starts a new one
+        with self._lock:
+            row = self._connection.execute("SELECT run_id FROM runs WHERE finished_at IS NULL ORDER BY run_id DESC LIMIT 1").fetchone()
+            if row is not None:
+                print(f"Resuming crawl run {row[0]}.")
+                return row[0]
+
+            run_id = self._connection.execute("INSERT INTO runs (started_at) VALUES (?)", (time.time(),)).lastrowid
+            self._connection.commit()
+            return run_id
+
+    def finish_run(self, run_id):
+        with self._lock:
+            self._connection.execute("UPDATE runs SET finished_at = ? WHERE run_id = ?", (time.time(), run_id))
+            self._connection.commit()
+
+    def mark_seen(self, urls_with_lastmod, run_id):
+
+        # Records the web pages (and their sitemap lastmod) found in the
+        # sitemap during the run
+        with self._lock:
+            self._connection.executemany(
+                "INSERT INTO pages (url, sitemap_lastmod, status, seen_run_id, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET sitemap_lastmod = excluded.sitemap_lastmod, seen_run_id = excluded.seen_run_id",
+                [(url, lastmod, status_pending, run_id, time.time()) for url, lastmod in urls_with_lastmod]
+            )
+            self._connection.commit()
+
+    def get_entry(self, url):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT sitemap_lastmod, lastmod, content_hash, vector_ids, status, run_id FROM pages WHERE url = ?",
+                (url,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        sitemap_lastmod, lastmod, content_hash, vector_ids, status, entry_run_id = row
+        return {
+            "url": url,
+            "sitemap_lastmod": sitemap_lastmod,
+            "lastmod": lastmod,
+            "content_hash": content_hash,
+            "vector_ids": json.loads(vector_ids),
+            "status": status,
+            "run_id": entry_run_id,
+        }
+
+    def needs_processing(self, url, run_id):
+
+        # A web page is skipped when it was already processed during this run
+        # (the run is being resumed), or when its sitemap lastmod has not
+        # changed since it was ingested
+        entry = self.get_entry(url)
+        if entry is None or entry["status"] != status_done:
+            return True
+        if entry["run_id"] == run_id:
+            return False
+        return entry["sitemap_lastmod"] is None or entry["sitemap_lastmod"] != entry["lastmod"]
+
+    def is_unchanged(self, url, content_hash):
+        entry = self.get_entry(url)
+        return entry is not None and entry["status"] == status_done and entry["content_hash"] == content_hash
+
+    def mark_done(self, url, content_hash, vector_ids, run_id):
+
+        # Records the ingested version of the web page, and returns the IDs of
+        # the vectors of its previous version that are no longer used
+        entry = self.get_entry(url)
+        stale_vector_ids = [id for id in entry["vector_ids"] if id not in set(vector_ids)] if entry is not None else []
+
+        with self._lock:
+            self._connection.execute(
+                "UPDATE pages SET lastmod = sitemap_lastmod, content_hash = ?, vector_ids = ?, status = ?, run_id = ?, updated_at = ? WHERE url = ?",
+                (content_hash, json.dumps(list(dict.fromkeys(vector_ids))), status_done, run_id, time.time(), url)
+            )
+            self._connection.commit()
+
+        return stale_vector_ids
+
+    def mark_unchanged(self, url, run_id):
+
+        # Records that the ingested version of the web page is up to date
+        with self._lock:
+            self._connection.execute(
+                "UPDATE pages SET lastmod = sitemap_lastmod, status = ?, run_id = ?, updated_at = ? WHERE url = ?",
+                (status_done, run_id, time.time(), url)
+            )
+            self._connection.commit()
+
+    def mark_failed(self, url, run_id):
+
+        # The ingested version (if any) is kept, and the web page is retried
+        # during the next run
+        with self._lock:
+            self._connection.execute("UPDATE pages SET status = ?, run_id = ?, updated_at = ? WHERE url = ?", (status_failed, run_id, time.time(), url))
+            self._connection.commit()
+
+    def pop_removed_entries(self, run_id):
+
+        # Marks the web pages that were not found in the sitemap during the run
+        # as removed, and returns their URLs and vector IDs
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT url, vector_ids FROM pages WHERE status != ? AND (seen_run_id IS NULL OR seen_run_id != ?)",
+                (status_removed, run_id)
+            ).fetchall()
+            self._connection.executemany(
+                "UPDATE pages SET status = ?, vector_ids = '[]', run_id = ?, updated_at = ? WHERE url = ?",
+                [(status_removed, run_id, time.time(), url) for url, _ in rows]
+            )
+            self._connection.commit()
+
+        return [(url, json.loads(vector_ids)) for url, vector_ids in rows]
+
+def get_crawl_ledger():
+    global _crawl_ledger
+
+    with _crawl_ledger_lock:
+        if _crawl_ledger is None:
+            _crawl_ledger = CrawlLedger(crawl_ledger_path)
+        return _crawl_ledger
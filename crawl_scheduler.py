@@ -0,0 +1,158 @@
+from urllib.parse import urlsplit
+from datetime import datetime
+import asyncio
+import random
+import time
+import os
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# Politeness toward the repository: every host gets a token bucket that
+# allows a sustained rate of requests per second, with short bursts
+crawl_host_rate = float(os.getenv("SCRAPER_HOST_RATE", "2"))
+crawl_host_burst = int(os.getenv("SCRAPER_HOST_BURST", "5"))
+
+# A failed or timed out URL is retried with an exponential backoff (with full
+# jitter, so that retries of the workers do not line up), up to max retries
+crawl_max_retries = int(os.getenv("SCRAPER_MAX_RETRIES", "3"))
+crawl_backoff_seconds = float(os.getenv("SCRAPER_RETRY_BACKOFF_SECONDS", "1"))
+crawl_backoff_max_seconds = float(os.getenv("SCRAPER_RETRY_BACKOFF_MAX_SECONDS", "30"))
+crawl_url_timeout_seconds = float(os.getenv("SCRAPER_URL_TIMEOUT_SECONDS", "90"))
+
+# The throughput and error counters are printed every stats interval URLs
+crawl_stats_interval = 100
+
+def get_lastmod_priority(lastmod):
+
+    # Queue priority of a URL (lower first): recently modified web pages
+    # first, and web pages without a (valid) lastmod last
+    if not lastmod:
+        return 0.0
+    try:
+        return -datetime.fromisoformat(lastmod).timestamp()
+    except ValueError:
+        return 0.0
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+
+        # Waits until a token is available; the lock makes the waiting
+        # callers take the tokens in order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class CrawlScheduler:
+
+    # Runs the (blocking) scraping of every URL in one shared executor, after
+    # taking a token from the bucket of the URL host, with a timeout per
+    # attempt and jittered backoff retries, and keeps throughput and error
+    # counters
+
+    def __init__(self, executor, host_rate=crawl_host_rate, host_burst=crawl_host_burst, max_retries=crawl_max_retries,
+                 backoff_seconds=crawl_backoff_seconds, backoff_max_seconds=crawl_backoff_max_seconds, url_timeout_seconds=crawl_url_timeout_seconds):
+        self.executor = executor
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.url_timeout_seconds = url_timeout_seconds
+
+        self._token_buckets = {}
+        self._started_at = time.monotonic()
+        self.counters = {"succeeded": 0, "failed": 0, "retried": 0, "timed_out": 0}
+
+    def _get_token_bucket(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._token_buckets:
+            self._token_buckets[host] = TokenBucket(self.host_rate, self.host_burst)
+        return self._token_buckets[host]
+
+    def get_backoff_seconds(self, attempt):
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_seconds * 2 ** attempt))
+
+    async def run(self, url, function, *args):
+
+        # Returns function(*args) for the URL, or raises the last error once
+        # every retry has failed; a timed out attempt keeps its executor
+        # thread until the blocking call returns, so the page timeout of the
+        # function should be shorter than the URL timeout, and the retry
+        # waits for the timed out attempt to return, so that the same URL is
+        # never fetched twice at the same time
+        loop = asyncio.get_running_loop()
+        token_bucket = self._get_token_bucket(url)
+
+        for attempt in range(self.max_retries + 1):
+            await token_bucket.acquire()
+
+            attempt_future = loop.run_in_executor(self.executor, function, *args)
+
+            try:
+                result = await asyncio.wait_for(asyncio.shield(attempt_future), self.url_timeout_seconds)
+
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self.counters["timed_out"] += 1
+                    e = TimeoutError(f"Timed out after {self.url_timeout_seconds} seconds")
+                    await asyncio.wait({attempt_future})
+
+                    # The late result (or error) of the timed out attempt is
+                    # discarded, and retrieved so that asyncio does not log it
+                    if not attempt_future.cancelled():
+                        attempt_future.exception()
+
+                if attempt == self.max_retries:
+                    self.counters["failed"] += 1
+                    self._print_stats_on_interval()
+                    raise e
+
+                self.counters["retried"] += 1
+                backoff_seconds = self.get_backoff_seconds(attempt)
+                print(f"Retrying URL {url} in {backoff_seconds:.1f} seconds after error: {e}")
+                await asyncio.sleep(backoff_seconds)
+                continue
+
+            self.counters["succeeded"] += 1
+            self._print_stats_on_interval()
+            return result
+
+    def get_stats(self):
+        elapsed_seconds = max(time.monotonic() - self._started_at, 1e-9)
+        completed = self.counters["succeeded"] + self.counters["failed"]
+
+        return {
+            **self.counters,
+            "elapsed_seconds": elapsed_seconds,
+            "pages_per_second": self.counters["succeeded"] / elapsed_seconds,
+            "error_rate": self.counters["failed"] / completed if completed else 0.0,
+        }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return (
+            f"{stats['succeeded']} scraped, {stats['failed']} failed, {stats['retried']} retries, {stats['timed_out']} timeouts, "
+            f"{stats['pages_per_second']:.2f} pages/s, {stats['error_rate']:.1%} errors"
+        )
+
+    def _print_stats_on_interval(self):
+        if (self.counters["succeeded"] + self.counters["failed"]) % crawl_stats_interval == 0:
+            print(f"Crawl stats: {self.format_stats()}")
@@ -0,0 +1,134 @@
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from webdriver_manager.chrome import ChromeDriverManager
+from contextlib import contextmanager
+import functools
+import queue
+import threading
+import time
+import os
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# A pooled driver is recycled (quit and replaced by a new browser) after it
+# has been alive for the max age, or has loaded the max number of pages
+driver_max_age_seconds = float(os.getenv("SCRAPER_DRIVER_MAX_AGE_SECONDS", "1800"))
+driver_max_pages = int(os.getenv("SCRAPER_DRIVER_MAX_PAGES", "200"))
+
+@functools.lru_cache(maxsize=1)
+def resolve_chrome_driver_path():
+
+    # Use webdriver-manager to manage ChromeDriver; the driver binary is
+    # resolved (and downloaded if needed) only once per process
+    return ChromeDriverManager().install()
+
+def create_chrome_driver(page_load_timeout_seconds=None):
+
+    # Configure headless Chrome
+    options = Options()
+    options.add_argument('--headless')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
+
+    service = Service(resolve_chrome_driver_path())
+
+    # Initialize the Chrome WebDriver with the service and options
+    driver = webdriver.Chrome(service=service, options=options)
+
+    # Bound driver.get, which otherwise waits up to Selenium's default of
+    # 300 seconds for a page that never finishes loading
+    if page_load_timeout_seconds is not None:
+        driver.set_page_load_timeout(page_load_timeout_seconds)
+
+    return driver
+
+class PooledDriver:
+    def __init__(self, driver):
+        self.driver = driver
+        self.created_at = time.monotonic()
+        self.page_count = 0
+
+    def is_expired(self, max_age_seconds, max_pages):
+        return time.monotonic() - self.created_at > max_age_seconds or self.page_count >= max_pages
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            print(f"Could not quit the Chrome driver: {e}")
+
+class ChromeDriverPool:
+
+    # A fixed-size pool of long-lived headless Chrome drivers; drivers are
+    # started lazily, checked out for one URL at a time, and recycled when
+    # they crash or exceed their age or page budget; a checkout waits at most
+    # the checkout timeout for a driver to become available
+
+    def __init__(self, size, max_age_seconds=driver_max_age_seconds, max_pages=driver_max_pages, page_load_timeout_seconds=None, checkout_timeout_seconds=None):
+        self.size = size
+        self.max_age_seconds = max_age_seconds
+        self.max_pages = max_pages
+        self.page_load_timeout_seconds = page_load_timeout_seconds
+        self.checkout_timeout_seconds = checkout_timeout_seconds
+
+        self._closed = False
+        self._lock = threading.Lock()
+        self._all_drivers = set()
+
+        # Empty slots (None) are filled with a new driver on checkout
+        self._available = queue.Queue()
+        for _ in range(size):
+            self._available.put(None)
+
+    def _retire(self, pooled_driver):
+        with self._lock:
+            self._all_drivers.discard(pooled_driver)
+        pooled_driver.quit()
+
+    @contextmanager
+    def checkout(self):
+        try:
+            pooled_driver = self._available.get(timeout=self.checkout_timeout_seconds)
+        except queue.Empty:
+            raise TimeoutError(f"No Chrome driver became available within {self.checkout_timeout_seconds} seconds")
+
+        try:
+            if pooled_driver is not None and pooled_driver.is_expired(self.max_age_seconds, self.max_pages):
+                self._retire(pooled_driver)
+                pooled_driver = None
+
+            if pooled_driver is None:
+                pooled_driver = PooledDriver(create_chrome_driver(self.page_load_timeout_seconds))
+                with self._lock:
+                    self._all_drivers.add(pooled_driver)
+
+            yield pooled_driver.driver
+
+            pooled_driver.page_count += 1
+
+        except WebDriverException:
+            # The browser may have crashed or hung, so it is replaced
+            if pooled_driver is not None:
+                self._retire(pooled_driver)
+                pooled_driver = None
+            raise
+
+        finally:
+            if self._closed and pooled_driver is not None:
+                self._retire(pooled_driver)
+                pooled_driver = None
+            self._available.put(pooled_driver)
+
+    def close(self):
+        self._closed = True
+
+        with self._lock:
+            pooled_drivers = list(self._all_drivers)
+            self._all_drivers.clear()
+
+        for pooled_driver in pooled_drivers:
+            pooled_driver.quit()
@@ -0,0 +1,207 @@
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote_plus, urlencode
+import threading
+import os
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+fosrc_server_link = os.getenv("FOSRC_SERVER_LINK")
+
+# Timeouts of the requests to the DSpace server, and the maximum number of
+# pooled (keep-alive) connections per client
+dspace_connect_timeout_seconds = float(os.getenv("DSPACE_CONNECT_TIMEOUT_SECONDS", "5"))
+dspace_request_timeout_seconds = float(os.getenv("DSPACE_REQUEST_TIMEOUT_SECONDS", "30"))
+dspace_max_connections = int(os.getenv("DSPACE_MAX_CONNECTIONS", "10"))
+
+search_objects_path = "/server/api/discover/search/objects"
+
+_dspace_client = None
+_dspace_client_lock = threading.Lock()
+
+def custom_title_capitalization(text_string, no_caps_list=None):
+    if no_caps_list is None:
+        no_caps_list = ["a", "an", "the", "and", "but", "or", "for", "nor", "on", "in", "at", "to", "with", "of"]
+
+    words = []
+    for word in text_string.split():
+        if word.lower() not in no_caps_list:
+            words.append(word.capitalize())
+        else:
+            words.append(word.lower())  # Keep excluded words in lowercase
+    return " ".join(words)
+
+def build_search_filters(search_query, authors, subjects, min_date, max_date, item_types, communities):
+
+    # Returns the search query and the list of (filter name, filter value)
+    # DSpace filters of the search, shared by the count and results searches
+    search_filters = []
+
+    if authors:
+        for author in authors:
+            if author:
+                search_filters.append(("f.author", custom_title_capitalization(author)))
+
+    if subjects:
+        for subject in subjects:
+            if subject:
+                search_filters.append(("f.subjectEn", subject.capitalize()))
+
+    date_range_string = ""
+
+    if min_date and max_date:
+        date_range_string = f"[{min_date} TO {max_date}]"
+    elif min_date and not max_date:
+        date_range_string = f"[{min_date} TO *]"
+    elif max_date and not min_date:
+        date_range_string = f"[* TO {max_date}]"
+
+    if date_range_string:
+        search_filters.append(("f.dateIssued", date_range_string))
+
+    if item_types:
+        for item_type in item_types:
+            if item_type:
+                search_filters.append(("f.itemtype_en", item_type.capitalize()))
+
+    if communities:
+        for community in communities:
+            if community:
+                search_filters.append(("f.community_en", custom_title_capitalization(community)))
+
+    return search_query if search_query else "", search_filters
+
+def build_search_query_string(search_query, search_filters, size, page=0, sort="score,DESC", dso_type=None):
+
+    # The filter values are encoded, but not the ",equals" operator
+    params = {"sort": sort, "page": page, "size": size, "query": search_query}
+    if dso_type:
+        params["dsoType"] = dso_type
+
+    return "&".join([urlencode(params)] + [f"{name}={quote_plus(value)},equals" for name, value in search_filters])
+
+def get_search_result(response_json):
+    return response_json.get("_embedded").get("searchResult")
+
+def get_results_count(search_result):
+    return search_result.get("page").get("totalElements")
+
+def get_result_items(search_result):
+    return [result.get("_embedded").get("indexableObject") for result in search_result.get("_embedded", {}).get("objects") or []]
+
+def get_item_link(item, server_link=None):
+    return ((server_link or fosrc_server_link) + "/items/" + item.get("id")) if item.get("id", "") else ""
+
+class DSpaceClient:
+
+    # Client of the DSpace REST API (and web pages) of the repository, with a
+    # pooled keep-alive session shared by all the calls
+
+    def __init__(self, server_link=None, max_connections=dspace_max_connections, connect_timeout_seconds=dspace_connect_timeout_seconds, timeout_seconds=dspace_request_timeout_seconds):
+        self.server_link = server_link or fosrc_server_link
+        self.timeout = (connect_timeout_seconds, timeout_seconds)
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections))
+        self.session.mount("http://", HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections))
+
+    def get(self, url, **kwargs):
+
+        # Relative URLs are relative to the server link
+        if url.startswith("/"):
+            url = self.server_link + url
+        return self.session.get(url, timeout=kwargs.pop("timeout", self.timeout), **kwargs)
+
+    def get_json(self, url, params=None):
+        response = self.get(url, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def get_search_url(self, search_query, search_filters, size, page=0, sort="score,DESC", dso_type=None):
+        return self.server_link + search_objects_path + "?" + build_search_query_string(search_query, search_filters, size, page, sort, dso_type)
+
+    def search(self, search_query, search_filters, size, page=0, sort="score,DESC", dso_type=None):
+
+        # Returns the searchResult of the discovery search
+        url = self.get_search_url(search_query, search_filters, size, page, sort, dso_type)
+        print(url)
+        return get_search_result(self.get_json(url))
+
+    def get_item_pdf_links(self, item_id):
+
+        # Returns the content links of the PDF bitstreams in the ORIGINAL bundle
+        bundles = self.get_json(f"/server/api/core/items/{item_id}/bundles").get("_embedded", {}).get("bundles") or []
+
+        pdf_links = []
+        for bundle in bundles:
+            if bundle.get("name") != "ORIGINAL":
+                continue
+            bitstreams = self.get_json(bundle.get("_links").get("bitstreams").get("href")).get("_embedded", {}).get("bitstreams") or []
+            for bitstream in bitstreams:
+                if (bitstream.get("name") or "").lower().endswith(".pdf"):
+                    pdf_links.append(bitstream.get("_links").get("content").get("href"))
+
+        return pdf_links
+
+    def download(self, url):
+        response = self.get(url)
+        response.raise_for_status()
+        return response.content
+
+class AsyncDSpaceClient:
+
+    # Async variant of the client (httpx), with a pool of keep-alive
+    # connections; use it as an async context manager, or call aclose
+
+    def __init__(self, server_link=None, max_connections=dspace_max_connections, connect_timeout_seconds=dspace_connect_timeout_seconds, timeout_seconds=dspace_request_timeout_seconds):
+        self.server_link = server_link or fosrc_server_link
+
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout_seconds, connect=connect_timeout_seconds),
+            follow_redirects=True
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def _get_url(self, url):
+        return self.server_link + url if url.startswith("/") else url
+
+    async def get(self, url, **kwargs):
+        return await self.client.get(self._get_url(url), **kwargs)
+
+    def stream(self, url, **kwargs):
+        return self.client.stream("GET", self._get_url(url), **kwargs)
+
+    async def get_json(self, url, params=None):
+        response = await self.get(url, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def get_search_url(self, search_query, search_filters, size, page=0, sort="score,DESC", dso_type=None):
+        return self.server_link + search_objects_path + "?" + build_search_query_string(search_query, search_filters, size, page, sort, dso_type)
+
+    async def search(self, search_query, search_filters, size, page=0, sort="score,DESC", dso_type=None):
+        url = self.get_search_url(search_query, search_filters, size, page, sort, dso_type)
+        print(url)
+        return get_search_result(await self.get_json(url))
+
+def get_dspace_client():
+    global _dspace_client
+
+    # The synchronous client is created once per process, and shared by the
+    # tool functions, the scraper and the DSpace ingestion
+    with _dspace_client_lock:
+        if _dspace_client is None:
+            _dspace_client = DSpaceClient()
+        return _dspace_client
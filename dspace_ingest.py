@@ -0,0 +1,145 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from chunking import iter_token_chunks
+from citation import format_citation
+from dspace_client import DSpaceClient, get_item_link, get_result_items
+from upload import iter_pdf_chunk_batches
+from vector_store import add_new_texts, delete_stale_source_texts, get_pdf_vector_store, persist_vector_store
+import os
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# Number of items requested per page of the DSpace REST API, number of
+# items (and API pages) processed at the same time, and the maximum number
+# of items to ingest (0 ingests every item)
+dspace_ingest_page_size = int(os.getenv("DSPACE_INGEST_PAGE_SIZE", "100"))
+dspace_ingest_workers = int(os.getenv("DSPACE_INGEST_WORKERS", "8"))
+dspace_ingest_item_limit = int(os.getenv("DSPACE_INGEST_ITEM_LIMIT", "0"))
+
+# Maximum number of items submitted to the workers (and of API pages
+# requested ahead), so that only a window of the repository is in memory
+dspace_ingest_window = dspace_ingest_workers * 2
+
+dspace_client = DSpaceClient(max_connections=dspace_ingest_workers)
+
+def get_search_page(page):
+
+    # Returns one page of the search results for all the items
+    return dspace_client.search("", [], size=dspace_ingest_page_size, page=page, sort="dc.date.accessioned,DESC", dso_type="ITEM")
+
+def iter_items():
+
+    # Yields every item; after the first page has given the page count, the
+    # next pages of the search results are fetched ahead in a bounded
+    # window, while the items of the current page are consumed
+    first_page = get_search_page(0)
+    total_pages = first_page.get("page").get("totalPages")
+
+    yield from get_result_items(first_page)
+
+    next_pages = iter(range(1, total_pages))
+
+    with ThreadPoolExecutor(max_workers=dspace_ingest_workers) as executor:
+        page_futures = deque(executor.submit(get_search_page, page) for page in islice(next_pages, dspace_ingest_workers))
+
+        while page_futures:
+            search_page = page_futures.popleft().result()
+
+            next_page = next(next_pages, None)
+            if next_page is not None:
+                page_futures.append(executor.submit(get_search_page, next_page))
+
+            yield from get_result_items(search_page)
+
+def get_metadata_values(item, key):
+    return [metadata_value.get("value") for metadata_value in item.get("metadata", {}).get(key, []) if metadata_value.get("value")]
+
+def ingest_item(item, pc_vector_store):
+
+    # Embeds and upserts the item metadata and the text of its PDFs; all the
+    # chunks of the item share one source, so that the chunks of a replaced
+    # or removed bitstream are deleted when the item is ingested again
+    item_source_id = f"dspace:{item.get('id')}"
+    item_link = get_item_link(item)
+    title = item.get("name") or next(iter(get_metadata_values(item, "dc.title")), "No title")
+
+    # Every dc.contributor.author value is one author (organizations such as
+    # "Fisheries and Oceans Canada" are cited verbatim by format_citation)
+    citation_metadata = {
+        "title": title,
+        "authors": get_metadata_values(item, "dc.contributor.author"),
+        "year": next(iter(get_metadata_values(item, "dc.date.issued")), "")[:4],
+        "doi": next(iter(get_metadata_values(item, "dc.identifier.doi")), None),
+    }
+    citation = format_citation(citation_metadata, "APA") or f"{title}. {item_link}"
+
+    metadata = {"url": item_link, "title": title, "citation": citation}
+
+    # The item metadata (title, authors, abstract) is ingested as well, so
+    # items without a PDF can still be retrieved
+    item_text = "\n".join([title] + citation_metadata["authors"] + get_metadata_values(item, "dc.description.abstract"))
+    item_chunks = list(iter_token_chunks([item_text], "dspace"))
+    item_ids = add_new_texts(pc_vector_store, item_chunks, [dict(metadata) for _ in item_chunks], source_id=item_source_id)
+
+    for pdf_link in dspace_client.get_item_pdf_links(item.get("id")):
+        pdf_bytes = dspace_client.download(pdf_link)
+
+        # The PDF text goes through the same chunk, embed and upsert stage
+        # as the PDFs uploaded in the app, without the PDF text cache
+        for char_split_text_batch in iter_pdf_chunk_batches(pdf_bytes, "dspace", use_cache=False):
+            item_ids.extend(add_new_texts(pc_vector_store, char_split_text_batch, [dict(metadata) for _ in char_split_text_batch], source_id=item_source_id))
+
+    # Only reached when the metadata and every PDF have been ingested
+    delete_stale_source_texts(pc_vector_store, item_source_id, item_ids)
+
+    print(f"Ingested item: {title}")
+
+def main():
+    pc_vector_store = get_pdf_vector_store()
+
+    items = iter_items()
+    if dspace_ingest_item_limit > 0:
+        items = islice(items, dspace_ingest_item_limit)
+
+    failed_count = 0
+    ingested_count = 0
+
+    def ingest_item_safely(item):
+        try:
+            ingest_item(item, pc_vector_store)
+            return True
+        except Exception as e:
+            print(f"Ingestion failed for item {item.get('id')}: {e}")
+            return False
+
+    # The items are pulled from the generator only when the window has room,
+    # instead of submitting the whole repository at once
+    with ThreadPoolExecutor(max_workers=dspace_ingest_workers) as executor:
+        pending_futures = set()
+
+        for item in items:
+            if len(pending_futures) >= dspace_ingest_window:
+                done_futures, pending_futures = wait(pending_futures, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    if future.result():
+                        ingested_count += 1
+                    else:
+                        failed_count += 1
+
+            pending_futures.add(executor.submit(ingest_item_safely, item))
+
+        for future in wait(pending_futures).done:
+            if future.result():
+                ingested_count += 1
+            else:
+                failed_count += 1
+
+    persist_vector_store()
+
+    print(f"Ingested {ingested_count} items from the DSpace REST API ({failed_count} failed).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+from langchain_core.embeddings import Embeddings
+from langchain_openai.embeddings import OpenAIEmbeddings
+from array import array
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+openai_api_key = os.getenv("OPENAI_API_KEY")
+
+# The embedding cache is a SQLite database of float32 vectors keyed by the
+# embedding model name and a hash of the text; when it holds more than the
+# max entries, the least recently used vectors are evicted
+embedding_cache_enabled = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(".cache", "embeddings.sqlite3"))
+embedding_cache_max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+
+# How long a cache read or write waits for the cache file to be unlocked
+# (e.g. while the scraper writes a large batch) before the cache is skipped
+# and the embedding API is called instead
+embedding_cache_timeout_seconds = float(os.getenv("EMBEDDING_CACHE_TIMEOUT_SECONDS", "1"))
+
+# The last used time of cache hits is written in batches, at most every
+# touch interval or every touch batch size hits
+embedding_cache_touch_interval_seconds = 60
+embedding_cache_touch_batch_size = 1000
+
+embedding_model = "text-embedding-3-small"
+
+_embeddings_by_model = {}
+_embeddings_by_model_lock = threading.Lock()
+
+class CachedEmbeddings(Embeddings):
+
+    def __init__(self, embeddings, model_name, cache_path, max_entries, timeout_seconds=embedding_cache_timeout_seconds):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._pending_touches = {}
+        self._last_touch_flush = time.monotonic()
+
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+
+        # WAL mode lets the app and the scraper share the cache file
+        self._connection = sqlite3.connect(cache_path, timeout=timeout_seconds, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._connection.commit()
+
+    def _get_key(self, text):
+        return hashlib.sha256(f"{self.model_name}\n{text}".encode("utf-8")).hexdigest()
+
+    def _flush_touches(self):
+
+        # Writes the last used time of the pending cache hits; the caller
+        # holds the lock and handles the SQLite errors
+        if self._pending_touches:
+            self._connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(last_used, key) for key, last_used in self._pending_touches.items()]
+            )
+            self._pending_touches = {}
+        self._last_touch_flush = time.monotonic()
+
+    def _get_cached_vectors(self, keys):
+
+        # A cache that cannot be read (locked, full or corrupt) is skipped,
+        # and the texts are embedded with the embedding API
+        cached_vectors = {}
+        unique_keys = list(dict.fromkeys(keys))
+
+        with self._lock:
+            try:
+                # SQLite limits the number of query parameters, so the
+                # keys are looked up in batches
+                for i in range(0, len(unique_keys), 500):
+                    keys_batch = unique_keys[i:i + 500]
+                    rows = self._connection.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(keys_batch))})",
+                        keys_batch
+                    ).fetchall()
+                    for key, vector in rows:
+                        cached_vectors[key] = array("f", vector).tolist()
+            except sqlite3.Error as e:
+                print(f"Could not read the embedding cache: {e}")
+                return {}
+
+            now = time.time()
+            for key in cached_vectors:
+                self._pending_touches[key] = now
+
+            if len(self._pending_touches) >= embedding_cache_touch_batch_size or time.monotonic() - self._last_touch_flush >= embedding_cache_touch_interval_seconds:
+                try:
+                    self._flush_touches()
+                    self._connection.commit()
+                except sqlite3.Error as e:
+                    print(f"Could not update the embedding cache: {e}")
+                    self._connection.rollback()
+
+        return cached_vectors
+
+    def _set_cached_vectors(self, vectors_by_key):
+        now = time.time()
+
+        # A cache that cannot be written is skipped, since the vectors have
+        # already been embedded
+        with self._lock:
+            try:
+                self._flush_touches()
+
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                    [(key, array("f", vector).tobytes(), now) for key, vector in vectors_by_key.items()]
+                )
+
+                # Evict the least recently used vectors beyond the max entries
+                entry_count = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                if entry_count > self.max_entries:
+                    self._connection.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                        (entry_count - self.max_entries,)
+                    )
+
+                self._connection.commit()
+            except sqlite3.Error as e:
+                print(f"Could not write the embedding cache: {e}")
+                self._connection.rollback()
+
+    def _get_missing_texts(self, texts, keys, cached_vectors):
+        missing_texts = {}
+        for text, key in zip(texts, keys):
+            if key not in cached_vectors and key not in missing_texts:
+                missing_texts[key] = text
+        return missing_texts
+
+    def embed_documents(self, texts):
+        keys = [self._get_key(text) for text in texts]
+        cached_vectors = self._get_cached_vectors(keys)
+
+        # Only the texts that are not in the cache are sent to the embedding API
+        missing_texts = self._get_missing_texts(texts, keys, cached_vectors)
+        if missing_texts:
+            new_vectors = dict(zip(missing_texts, self.embeddings.embed_documents(list(missing_texts.values()))))
+            self._set_cached_vectors(new_vectors)
+            cached_vectors.update(new_vectors)
+
+        return [cached_vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self._get_key(text)
+        cached_vectors = self._get_cached_vectors([key])
+
+        if key not in cached_vectors:
+            cached_vectors[key] = self.embeddings.embed_query(text)
+            self._set_cached_vectors(cached_vectors)
+
+        return cached_vectors[key]
+
+    async def aembed_documents(self, texts):
+        keys = [self._get_key(text) for text in texts]
+        cached_vectors = self._get_cached_vectors(keys)
+
+        missing_texts = self._get_missing_texts(texts, keys, cached_vectors)
+        if missing_texts:
+            new_vectors = dict(zip(missing_texts, await self.embeddings.aembed_documents(list(missing_texts.values()))))
+            self._set_cached_vectors(new_vectors)
+            cached_vectors.update(new_vectors)
+
+        return [cached_vectors[key] for key in keys]
+
+    async def aembed_query(self, text):
+        key = self._get_key(text)
+        cached_vectors = self._get_cached_vectors([key])
+
+        if key not in cached_vectors:
+            cached_vectors[key] = await self.embeddings.aembed_query(text)
+            self._set_cached_vectors(cached_vectors)
+
+        return cached_vectors[key]
+
+def get_embeddings(model=embedding_model):
+
+    # Returns one shared (cached, if enabled) embeddings object per model
+    with _embeddings_by_model_lock:
+        if model not in _embeddings_by_model:
+            embeddings = OpenAIEmbeddings(model = model, openai_api_key=openai_api_key)
+
+            if embedding_cache_enabled:
+                embeddings = CachedEmbeddings(
+                    embeddings,
+                    model_name=model,
+                    cache_path=embedding_cache_path,
+                    max_entries=embedding_cache_max_entries
+                )
+
+            _embeddings_by_model[model] = embeddings
+
+        return _embeddings_by_model[model]
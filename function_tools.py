@@ -1,7 +1,11 @@
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from openai import OpenAI
 import requests
-from urllib.parse import quote_plus, urlencode
+from dspace_client import build_search_filters, get_dspace_client, get_item_link, get_result_items, get_results_count
+from search_cache import get_search_cache, get_search_signature
 from rag import generate_rag_runnable_chain
 # import streamlit as st
 import os
@@ -14,6 +18,17 @@ openai_api_key = os.getenv("OPENAI_API_KEY")
 gpt_model = os.getenv("GPT_MODEL")
 fosrc_server_link = os.getenv("FOSRC_SERVER_LINK")
 
+# Maximum number of tool calls running at the same time (shared by all the
+# conversations), and the timeout of every tool; the RAG tool makes its own
+# LLM call, so it gets a longer timeout than the DSpace searches
+tool_call_max_workers = int(os.getenv("TOOL_CALL_MAX_WORKERS", "8"))
+default_tool_call_timeout_seconds = float(os.getenv("TOOL_CALL_TIMEOUT_SECONDS", "30"))
+tool_call_timeout_seconds = {
+    "get_rag_response": float(os.getenv("RAG_TOOL_CALL_TIMEOUT_SECONDS", "90")),
+}
+
+tool_call_executor = ThreadPoolExecutor(max_workers=tool_call_max_workers)
+
 system_message = """
 You are a helpful assistant for the Federal Open Science Repository of Canada (FOSRC). Always be accurate. If you don't know the answer, say so. Do not add any of the following search filters unless specified by the user: size filter, search query filter, the authors filter, the subjects filter, the min date filter, the max date filter, the communities filter, and the item types filter.
 
@@ -25,89 +40,50 @@ Search results should be presented as a numbered list of items in the following
 where *Title* is only the result title, and *Link* is only the result link. If the title is missing, still present the item with the link.
 """
 
-def custom_title_capitalization(text_string, no_caps_list=None):
-    if no_caps_list is None:
-        no_caps_list = ["a", "an", "the", "and", "but", "or", "for", "nor", "on", "in", "at", "to", "with", "of"]
-
-    words = []
-    for word in text_string.split():
-        if word.lower() not in no_caps_list:
-            words.append(word.capitalize())
-        else:
-            words.append(word.lower())  # Keep excluded words in lowercase
-    return " ".join(words)
-
-def get_search_results_count(search_query, authors, subjects, min_date, max_date, item_types, communities):
-    print(f"get_search_results_count() called for search term: {search_query}")
-    
-    url = fosrc_server_link + "/server/api/discover/search/objects"
-
-    params = {
-        "sort": "score,DESC",
-        "page": 0,
-        "size": 0,
-        "query": search_query if search_query else ""
-    }
-
-    encoded_query_params_string = urlencode(params)
+def search_dspace(search_query, search_filters, size):
 
-    additional_query_parameters = []
+    # Returns the (possibly cached) searchResult, or None when the request fails
+    try:
+        search_result = get_search_cache().get_or_search(get_dspace_client(), search_query, search_filters, size=size)
+    except requests.RequestException as e:
+        print(f"Request failed: {e}")
+        return None
 
-    if authors:
-        for author in authors:
-            if author:
-                additional_query_parameters.append("f.author=" + quote_plus(custom_title_capitalization(author)) + ",equals")
+    print("Request successful!")
 
-    if subjects:
-        for subject in subjects:
-            if subject:
-                additional_query_parameters.append("f.subjectEn=" + quote_plus(subject.capitalize()) + ",equals")
+    return search_result
 
-    date_range_string = ""
-
-    if min_date and max_date:
-        date_range_string = f"[{min_date} TO {max_date}]"
-    elif min_date and not max_date:
-        date_range_string = f"[{min_date} TO *]"
-    elif max_date and not min_date:
-        date_range_string = f"[* TO {max_date}]"
+def format_search_results_count(search_result):
+    if search_result is None:
+        return ""
 
-    if date_range_string:
-        additional_query_parameters.append("f.dateIssued=" + quote_plus(date_range_string) + ",equals")
+    extracted_results_count = get_results_count(search_result)
+    print(extracted_results_count)
 
-    if item_types:
-        for item_type in item_types:
-            if item_type:
-                additional_query_parameters.append("f.itemtype_en=" + quote_plus(item_type.capitalize()) + ",equals")
+    return str(extracted_results_count)
 
-    if communities:
-        for community in communities:
-            if community:
-                additional_query_parameters.append("f.community_en=" + quote_plus(custom_title_capitalization(community)) + ",equals")
-    
-    additional_query_parameters_string = "&".join(additional_query_parameters)
-
-    modified_url = url + "?" + encoded_query_params_string + "&" + additional_query_parameters_string
-    
-    print(modified_url)
+def format_search_results(search_result, size=None):
+    if search_result is None:
+        return ""
 
-    response = requests.get(modified_url)
+    # A search shared by several tool calls may have more results than
+    # the size of this tool call
+    items = get_result_items(search_result)
+    if size is not None:
+        items = items[:size]
 
-    # Check the status code
-    if response.status_code == 200:
-        print("Request successful!")
+    modified_results_list = []
 
-        response_json = response.json()
+    for item in items:
+        modified_result = {
+            "title": item.get("name"),
+            # "abstract": item.get("metadata").get("dc.description.abstract", [])[0].get("value"),
+            "link": get_item_link(item),
+        }
+        modified_results_list.append(str(modified_result))
 
-        extracted_results_count = response_json.get("_embedded").get("searchResult").get("page").get("totalElements")
-        print(extracted_results_count)
+    return ", ".join(modified_results_list)
 
-        return str(extracted_results_count)
-    
-    else:
-        print(f"Request failed with status code: {response.status_code}")
-        return ""
-    
 get_search_results_count_function = {
     "name": "get_search_results_count",
     "description": "In FOSRC, get the number of search results based on the following filters: search query filter, the authors filter, the subjects filter, the min date filter, the max date filter, the communities filter, and the item types filter.",
@@ -192,86 +168,6 @@ get_search_results_count_function = {
     }
 }
 
-def get_search_results(size, search_query, authors, subjects, min_date, max_date, item_types, communities):
-    print(f"get_search_results_count() called for search term: {search_query}")
-    
-    url = fosrc_server_link + "/server/api/discover/search/objects"
-
-    params = {
-        "sort": "score,DESC",
-        "page": 0,
-        "size": size if size else "10",
-        "query": search_query if search_query else ""
-    }
-
-    encoded_query_params_string = urlencode(params)
-
-    additional_query_parameters = []
-
-    if authors:
-        for author in authors:
-            if author:
-                additional_query_parameters.append("f.author=" + quote_plus(custom_title_capitalization(author)) + ",equals")
-
-    if subjects:
-        for subject in subjects:
-            if subject:
-                additional_query_parameters.append("f.subjectEn=" + quote_plus(subject.capitalize()) + ",equals")
-
-    date_range_string = ""
-
-    if min_date and max_date:
-        date_range_string = f"[{min_date} TO {max_date}]"
-    elif min_date and not max_date:
-        date_range_string = f"[{min_date} TO *]"
-    elif max_date and not min_date:
-        date_range_string = f"[* TO {max_date}]"
-
-    if date_range_string:
-        additional_query_parameters.append("f.dateIssued=" + quote_plus(date_range_string) + ",equals")
-
-    if item_types:
-        for item_type in item_types:
-            if item_type:
-                additional_query_parameters.append("f.itemtype_en=" + quote_plus(item_type.capitalize()) + ",equals")
-
-    if communities:
-        for community in communities:
-            if community:
-                additional_query_parameters.append("f.community_en=" + quote_plus(custom_title_capitalization(community)) + ",equals")
-    
-    additional_query_parameters_string = "&".join(additional_query_parameters)
-
-    modified_url = url + "?" + encoded_query_params_string + "&" + additional_query_parameters_string
-    
-    print(modified_url)
-
-    response = requests.get(modified_url)
-
-    # Check the status code
-    if response.status_code == 200:
-        print("Request successful!")
-
-        response_json = response.json()
-
-        extracted_results = response_json.get("_embedded").get("searchResult").get("_embedded").get("objects") or []
-
-        modified_results_list = []
-
-        for result in extracted_results:
-            modified_result = {
-                "title": result.get("_embedded").get("indexableObject").get("name"),
-                # "abstract": result.get("_embedded").get("indexableObject").get("metadata").get("dc.description.abstract", [])[0].get("value"),
-                "link": (fosrc_server_link + "/items/" + result.get("_embedded").get("indexableObject").get("id")) if result.get("_embedded").get("indexableObject").get("id", "") else "",
-            }
-            modified_results_list.append(str(modified_result))
-
-        return ", ".join(modified_results_list)
-    
-    else:
-        print(f"Request failed with status code: {response.status_code}")
-        return ""
-    
 get_search_results_function = {
     "name": "get_search_results",
     "description": "In FOSRC, fetch the search results based on the following filters: size filter, search query filter, the authors filter, the subjects filter, the min date filter, the max date filter, the communities filter, and the item types filter.",
@@ -418,76 +314,125 @@ def get_open_ai_response(messages = [], use_tools = True):
             messages=messages
         )
 
+def run_tool_call(tool_call):
+    # The search tool calls with valid arguments share the searches planned
+    # by plan_search_requests, so only the invalid ones get here
+    if tool_call.function.name in ("get_search_results_count", "get_search_results"):
+        return "The search tool call arguments are invalid."
+
+    if tool_call.function.name == "get_rag_response":
+        arguments = json.loads(tool_call.function.arguments)
+        user_question = arguments.get('user_question')
+
+        response = get_rag_response(
+            user_question = user_question,
+        )
+
+        print(response)
+
+        return "Repeat the following text EXACTLY:\n" + response.choices[0].message.content if response.choices[0].message.content else "Repeat the following text EXACTLY:\nThe information is not available in FOSRC"
+
+    return f"Unknown tool: {tool_call.function.name}"
+
+def get_result_size(size):
+
+    # Number of results of a results tool call (10 when missing or invalid)
+    try:
+        return max(int(size), 0)
+    except (TypeError, ValueError):
+        return 10
+
+def plan_search_requests(tool_calls):
+
+    # Groups the count and results tool calls of the turn by search signature
+    # (the normalized query and filters), so that every signature is searched
+    # only once: a count is read from the totalElements of the results search
+    # with the same filters, and the search returns as many results as the
+    # largest results tool call of the group; returns the planned searches by
+    # signature, and the (signature, size) of every planned tool call by
+    # index (the size is None for count tool calls)
+    search_plans = {}
+    planned_tool_calls = {}
+
+    for i, tool_call in enumerate(tool_calls):
+        if tool_call.function.name not in ("get_search_results_count", "get_search_results"):
+            continue
+
+        # Tool calls with invalid arguments are answered by run_tool_call
+        try:
+            arguments = json.loads(tool_call.function.arguments)
+        except json.JSONDecodeError:
+            continue
+        if not isinstance(arguments, dict):
+            continue
+
+        print(f"{tool_call.function.name}() called for search term: {arguments.get('search_query')}")
+
+        search_query, search_filters = build_search_filters(
+            arguments.get('search_query'),
+            arguments.get('authors'),
+            arguments.get('subjects'),
+            arguments.get('min_date'),
+            arguments.get('max_date'),
+            arguments.get('item_types'),
+            arguments.get('communities')
+        )
+        size = get_result_size(arguments.get('size')) if tool_call.function.name == "get_search_results" else None
+
+        signature = get_search_signature(search_query, search_filters)
+        search_plan = search_plans.setdefault(signature, {"search_query": search_query, "search_filters": search_filters, "size": 0})
+        if size is not None:
+            search_plan["size"] = max(search_plan["size"], size)
+
+        planned_tool_calls[i] = (signature, size)
+
+    if planned_tool_calls:
+        print(f"Planned {len(search_plans)} DSpace searches for {len(planned_tool_calls)} search tool calls")
+
+    return search_plans, planned_tool_calls
+
 def handle_tool_calls(message):
+
+    # The tool calls of the turn run at the same time in the shared tool
+    # call executor, so the turn takes as long as the slowest tool call; the
+    # search tool calls with the same filters share one DSpace search; the
+    # responses are returned in the order of the tool calls, and a tool call
+    # that fails or exceeds its timeout gets an error response (the timed out
+    # call keeps its thread until it returns)
+    started_at = time.monotonic()
+
+    search_plans, planned_tool_calls = plan_search_requests(message.tool_calls)
+    search_futures = {
+        signature: tool_call_executor.submit(search_dspace, search_plan["search_query"], search_plan["search_filters"], search_plan["size"])
+        for signature, search_plan in search_plans.items()
+    }
+    futures = [None if i in planned_tool_calls else tool_call_executor.submit(run_tool_call, tool_call) for i, tool_call in enumerate(message.tool_calls)]
+
     responses = []
-    for tool_call in message.tool_calls:
-        if tool_call.function.name == "get_search_results_count":
-            arguments = json.loads(tool_call.function.arguments)
-            search_query = arguments.get('search_query')
-            authors = arguments.get('authors')
-            subjects = arguments.get('subjects')
-            min_date = arguments.get('min_date')
-            max_date = arguments.get('max_date')
-            item_types = arguments.get('item_types')
-            communities = arguments.get('communities')
-            
-            search_results_count = get_search_results_count(
-                search_query = search_query, 
-                authors = authors, 
-                subjects = subjects, 
-                min_date = min_date, 
-                max_date = max_date, 
-                item_types = item_types,
-                communities = communities
-            )
-            responses.append({
-                "role": "tool",
-                "content": search_results_count,
-                "tool_call_id": tool_call.id
-            })
-        if tool_call.function.name == "get_search_results":
-            arguments = json.loads(tool_call.function.arguments)
-            size = arguments.get('size')
-            search_query = arguments.get('search_query')
-            authors = arguments.get('authors')
-            subjects = arguments.get('subjects')
-            min_date = arguments.get('min_date')
-            max_date = arguments.get('max_date')
-            item_types = arguments.get('item_types')
-            communities = arguments.get('communities')
-            
-            search_results = get_search_results(
-                size = size,
-                search_query = search_query, 
-                authors = authors, 
-                subjects = subjects, 
-                min_date = min_date, 
-                max_date = max_date, 
-                item_types = item_types,
-                communities = communities
-            )
-
-            # print(search_results)
-            responses.append({
-                "role": "tool",
-                "content": search_results,
-                "tool_call_id": tool_call.id
-            })
-        if tool_call.function.name == "get_rag_response":
-            arguments = json.loads(tool_call.function.arguments)
-            user_question = arguments.get('user_question')
-            
-            response = get_rag_response(
-                user_question = user_question,
-            )
-
-            print(response)
-
-            responses.append({
-                "role": "tool",
-                "content": "Repeat the following text EXACTLY:\n" + response.choices[0].message.content if response.choices[0].message.content else "Repeat the following text EXACTLY:\nThe information is not available in FOSRC",
-                "tool_call_id": tool_call.id
-            })
+    for i, (tool_call, future) in enumerate(zip(message.tool_calls, futures)):
+        timeout_seconds = tool_call_timeout_seconds.get(tool_call.function.name, default_tool_call_timeout_seconds)
+        remaining_seconds = max(0, started_at + timeout_seconds - time.monotonic())
+
+        try:
+            if i in planned_tool_calls:
+                signature, size = planned_tool_calls[i]
+                search_result = search_futures[signature].result(timeout=remaining_seconds)
+                content = format_search_results_count(search_result) if size is None else format_search_results(search_result, size)
+            else:
+                content = future.result(timeout=remaining_seconds)
+        except FutureTimeoutError:
+            print(f"The tool call {tool_call.function.name} timed out after {timeout_seconds} seconds")
+            content = "The tool call timed out. The information is currently not available in FOSRC."
+        except Exception as e:
+            print(f"The tool call {tool_call.function.name} failed: {e}")
+            content = "The tool call failed. The information is currently not available in FOSRC."
+
+        responses.append({
+            "role": "tool",
+            "content": content,
+            "tool_call_id": tool_call.id
+        })
+
     return responses
 
 def get_fosrc_answer(user_question):
@@ -0,0 +1,304 @@
+from bs4 import BeautifulSoup, CData, NavigableString, UnicodeDammit
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
+import glob
+import time
+import sys
+import os
+from dotenv import load_dotenv
+
+try:
+    import lxml.html
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# Parser used to extract the title and text of the scraped web pages:
+# "html.parser" (BeautifulSoup, no extra package), "lxml" (requires the lxml
+# and cssselect packages), "selectolax" (requires the selectolax package), or
+# "auto" for the fastest installed one
+scraper_html_parser = os.getenv("SCRAPER_HTML_PARSER", "auto")
+
+# Number of processes extracting the web pages, so that parsing does not
+# hold the GIL of the scraping threads
+scraper_extraction_workers = int(os.getenv("SCRAPER_EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+
+# Elements removed from the body before the text is extracted
+irrelevant_tags = {"script", "style", "img", "input", "footer", "header", "nav", "ds-search-results"}
+
+# Elements whose content is not text (BeautifulSoup get_text skips them)
+non_text_tags = {"script", "style", "template"}
+
+_extraction_executor = None
+_extraction_executor_lock = threading.Lock()
+
+def _join_paragraph_strings(strings):
+
+    # Same as get_text(separator=" ", strip=True) on a p element
+    return " ".join(stripped_string for stripped_string in (string.strip() for string in strings) if stripped_string)
+
+def _extract_with_beautifulsoup(html, parser_features, selector):
+    soup = BeautifulSoup(html, parser_features)
+
+    matched = selector is None or soup.select_one(selector) is not None
+
+    h1 = soup.find('h1')
+    title = h1.get_text() if h1 else soup.title.string if soup.title and soup.title.string else "No title"
+
+    if soup.body is None:
+        return title, "", matched
+
+    # A single pass over the body: irrelevant elements are skipped, every p
+    # element becomes one line, and every other string becomes one line
+    lines = []
+    stack = [soup.body]
+    while stack:
+        node = stack.pop()
+
+        if isinstance(node, NavigableString):
+            if type(node) in (NavigableString, CData) and node.strip():
+                lines.append(node.strip())
+            continue
+
+        if node.name in irrelevant_tags:
+            continue
+
+        if node.name == "p":
+            paragraph_text = node.get_text(separator=" ", strip=True)
+            if paragraph_text:
+                lines.append(paragraph_text)
+            continue
+
+        stack.extend(reversed(node.contents))
+
+    return title, "\n".join(lines), matched
+
+def extract_with_html_parser(html, selector=None):
+    return _extract_with_beautifulsoup(html, "html.parser", selector)
+
+def _iter_lxml_strings(element):
+
+    # Yields the text strings inside the element (but not its tail), except
+    # the text of comments and non-text elements
+    if not isinstance(element.tag, str) or element.tag in non_text_tags:
+        return
+
+    if element.text:
+        yield element.text
+    for child in element:
+        yield from _iter_lxml_strings(child)
+        if child.tail:
+            yield child.tail
+
+def extract_with_lxml(html, selector=None):
+    root = lxml.html.document_fromstring(html)
+
+    matched = selector is None or bool(CSSSelector(selector)(root))
+
+    h1 = next(root.iter("h1"), None)
+    title_element = next(root.iter("title"), None)
+    title = "".join(_iter_lxml_strings(h1)) if h1 is not None else title_element.text if title_element is not None and title_element.text else "No title"
+
+    body = root.find("body")
+    if body is None:
+        return title, "", matched
+
+    lines = []
+    stack = [body]
+    while stack:
+        node = stack.pop()
+
+        if isinstance(node, str):
+            if node.strip():
+                lines.append(node.strip())
+            continue
+
+        if not isinstance(node.tag, str) or node.tag in irrelevant_tags or node.tag in non_text_tags:
+            continue
+
+        if node.tag == "p":
+            paragraph_text = _join_paragraph_strings(_iter_lxml_strings(node))
+            if paragraph_text:
+                lines.append(paragraph_text)
+            continue
+
+        children = [node.text] if node.text else []
+        for child in node:
+            children.append(child)
+            if child.tail:
+                children.append(child.tail)
+        stack.extend(reversed(children))
+
+    return title, "\n".join(lines), matched
+
+def _iter_selectolax_strings(node):
+
+    # Yields the text strings inside the node, except the text of comments
+    # and non-text elements
+    for child in node.iter(include_text=True):
+        if child.tag == "-text":
+            yield child.text(deep=False)
+        elif not child.tag.startswith("-") and child.tag not in non_text_tags:
+            yield from _iter_selectolax_strings(child)
+
+def extract_with_selectolax(html, selector=None):
+    tree = LexborHTMLParser(html)
+
+    matched = selector is None or tree.css_first(selector) is not None
+
+    h1 = tree.css_first("h1")
+    title_node = tree.css_first("title")
+    title = "".join(_iter_selectolax_strings(h1)) if h1 is not None else title_node.text() if title_node is not None and title_node.text() else "No title"
+
+    if tree.body is None:
+        return title, "", matched
+
+    lines = []
+    stack = [tree.body]
+    while stack:
+        node = stack.pop()
+
+        if node.tag == "-text":
+            text = node.text(deep=False).strip()
+            if text:
+                lines.append(text)
+            continue
+
+        if node.tag.startswith("-") or node.tag in irrelevant_tags or node.tag in non_text_tags:
+            continue
+
+        if node.tag == "p":
+            paragraph_text = _join_paragraph_strings(_iter_selectolax_strings(node))
+            if paragraph_text:
+                lines.append(paragraph_text)
+            continue
+
+        stack.extend(reversed(list(node.iter(include_text=True))))
+
+    return title, "\n".join(lines), matched
+
+# Available parsers, from the fastest to the slowest
+extractors = {}
+if LexborHTMLParser is not None:
+    extractors["selectolax"] = extract_with_selectolax
+if lxml is not None:
+    extractors["lxml"] = extract_with_lxml
+extractors["html.parser"] = extract_with_html_parser
+
+def get_extractor(parser_name=None):
+    parser_name = parser_name or scraper_html_parser
+
+    if parser_name == "auto":
+        return next(iter(extractors.values()))
+
+    if parser_name not in extractors:
+        raise ValueError(f"The HTML parser {parser_name} is unknown or not installed; the available parsers are: {', '.join(extractors)}")
+
+    return extractors[parser_name]
+
+def extract_page(html, selector=None, parser_name=None):
+
+    # Returns the title and the text of the web page, and whether the web
+    # page contains the selector; HTML bytes are decoded the way
+    # BeautifulSoup decodes them (BOM, meta charset, then detection), so
+    # every parser sees the same text
+    if isinstance(html, bytes):
+        html = UnicodeDammit(html, is_html=True).unicode_markup or ""
+
+    return get_extractor(parser_name)(html, selector)
+
+def extract_page_legacy(html, selector=None):
+
+    # The original extraction of the scraper (kept for the benchmark): every
+    # p element is replaced by its text, the irrelevant elements are
+    # decomposed, and the text of the remaining body is extracted
+    soup = BeautifulSoup(html, 'html.parser')
+
+    matched = selector is None or soup.select_one(selector) is not None
+
+    title = soup.find('h1').get_text() if soup.find('h1') else soup.title.string if soup.title else "No title"
+
+    for paragraph_elem in soup.find_all('p'):
+        modified_paragraph_text = paragraph_elem.get_text(separator=" ", strip=True)
+        paragraph_elem.replace_with(modified_paragraph_text)
+
+    for irrelevant in soup.body(list(irrelevant_tags)):
+        irrelevant.decompose()
+
+    return title, soup.body.get_text(separator="\n", strip=True), matched
+
+def _get_extraction_executor():
+    global _extraction_executor
+
+    with _extraction_executor_lock:
+        if _extraction_executor is None:
+            # The "spawn" start method is used because forking a
+            # multi-threaded process is unsafe, and because it is the
+            # only start method available on Windows
+            _extraction_executor = ProcessPoolExecutor(
+                max_workers=scraper_extraction_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _extraction_executor
+
+def _reset_extraction_executor():
+    global _extraction_executor
+
+    with _extraction_executor_lock:
+        if _extraction_executor is not None:
+            _extraction_executor.shutdown(wait=False, cancel_futures=True)
+        _extraction_executor = None
+
+def extract_page_in_process(html, selector=None, parser_name=None):
+
+    # Extracts the web page in the extraction process pool (or in-process
+    # with a single worker); the calling thread waits without holding the GIL
+    if scraper_extraction_workers <= 1:
+        return extract_page(html, selector, parser_name)
+
+    try:
+        return _get_extraction_executor().submit(extract_page, html, selector, parser_name).result()
+
+    except BrokenProcessPool:
+        print("The HTML extraction process pool stopped unexpectedly; extracting in-process instead.")
+        _reset_extraction_executor()
+        return extract_page(html, selector, parser_name)
+
+def run_benchmark(pages_directory):
+
+    # Measures the pages per second per core of every installed parser (and
+    # of the original extraction) on the saved web pages (*.html) in the
+    # directory, and checks that the outputs match the original extraction
+    pages = []
+    for page_path in sorted(glob.glob(os.path.join(pages_directory, "*.html"))):
+        with open(page_path, encoding="utf-8", errors="replace") as f:
+            pages.append(f.read())
+
+    if not pages:
+        print(f"No saved web pages (*.html) found in {pages_directory}")
+        return
+
+    print(f"Benchmarking {len(pages)} web pages ({sum(len(page) for page in pages) / len(pages) / 1024:.0f} KiB on average)")
+
+    legacy_results = [extract_page_legacy(page) for page in pages]
+
+    for name, extractor in [("legacy", extract_page_legacy)] + list(extractors.items()):
+        start = time.process_time()
+        results = [extractor(page) for page in pages]
+        cpu_seconds = max(time.process_time() - start, 1e-9)
+
+        matching_count = sum(result[:2] == legacy_result[:2] for result, legacy_result in zip(results, legacy_results))
+        print(f"{name:12s}: {len(pages) / cpu_seconds:8.1f} pages/s/core, output identical to the original extraction for {matching_count} of {len(pages)} web pages")
+
+if __name__ == "__main__":
+    run_benchmark(sys.argv[1] if len(sys.argv) > 1 else os.path.join(".cache", "saved_pages"))
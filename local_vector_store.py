@@ -0,0 +1,365 @@
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+import numpy as np
+import json
+import os
+import sqlite3
+import threading
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Local vector stores keep the normalized float32 vectors in an append-only
+# file that is memory-mapped on startup, and the chunk IDs, texts and
+# metadata in a SQLite database, both in the persist directory; several
+# processes (such as the app and the scraper) can add texts to the same
+# store, since every append holds the SQLite write lock
+vectors_file_name = "vectors.f32"
+documents_file_name = "documents.sqlite3"
+hnsw_index_file_name = "hnsw.bin"
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+class NumpyVectorStore(VectorStore):
+
+    # Exact (brute-force) cosine similarity search over all the vectors
+    # with a single matrix-vector product
+
+    def __init__(self, embedding, persist_directory, dimension=1536):
+        self._embedding = embedding
+        self.persist_directory = persist_directory
+        self.dimension = dimension
+
+        self._lock = threading.RLock()
+
+        os.makedirs(persist_directory, exist_ok=True)
+
+        self._vectors_path = os.path.join(persist_directory, vectors_file_name)
+        open(self._vectors_path, "ab").close()
+
+        self._connection = sqlite3.connect(os.path.join(persist_directory, documents_file_name), timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS documents (row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, text TEXT NOT NULL, metadata TEXT NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)")
+
+        # Log of the deleted rows, so that every process sharing the store
+        # picks up the deletions of the others
+        self._connection.execute("CREATE TABLE IF NOT EXISTS deletions (seq INTEGER PRIMARY KEY AUTOINCREMENT, row INTEGER NOT NULL, id TEXT NOT NULL)")
+        self._connection.commit()
+
+        self._vectors = np.empty((0, dimension), dtype=np.float32)
+        self._row_count = 0
+        self._row_by_id = {}
+        self._active_rows = np.empty(0, dtype=bool)
+
+        # The rows deleted before startup are loaded with their deleted flag
+        self._deletion_seq = self._connection.execute("SELECT COALESCE(MAX(seq), 0) FROM deletions").fetchone()[0]
+        self._data_version = None
+
+        self._refresh()
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def _apply_deletions(self, deleted_rows):
+        for row, id in deleted_rows:
+            if self._row_by_id.get(id) == row:
+                del self._row_by_id[id]
+            if row < len(self._active_rows):
+                self._active_rows[row] = False
+
+    def _delete_rows(self, deleted_rows):
+
+        # Marks the (row, id) document rows as deleted and logs them for the
+        # other processes; the caller commits
+        self._connection.executemany("UPDATE documents SET deleted = 1, id = id || ':deleted:' || row WHERE row = ?", [(row,) for row, _ in deleted_rows])
+        self._connection.executemany("INSERT INTO deletions (row, id) VALUES (?, ?)", deleted_rows)
+        self._apply_deletions(deleted_rows)
+
+    def _refresh(self, force=False):
+
+        # Picks up the rows appended and deleted since the last refresh
+        # (possibly by another process, such as the scraper) by re-mapping
+        # the vector file, loading the new document rows and reading the
+        # deletion log; PRAGMA data_version only changes when another
+        # connection commits, so nothing is read when the store is unchanged,
+        # and vectors appended by a transaction that is not committed yet
+        # are picked up later
+        with self._lock:
+            data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+            if not force and data_version == self._data_version:
+                return False
+            self._data_version = data_version
+
+            deletions = self._connection.execute("SELECT seq, row, id FROM deletions WHERE seq > ? ORDER BY seq", (self._deletion_seq,)).fetchall()
+            if deletions:
+                self._apply_deletions([(row, id) for _, row, id in deletions])
+                self._deletion_seq = deletions[-1][0]
+
+            file_row_count = os.path.getsize(self._vectors_path) // (4 * self.dimension)
+            committed_row_count = (self._connection.execute("SELECT MAX(row) FROM documents").fetchone()[0] or -1) + 1
+            row_count = min(file_row_count, max(committed_row_count, self._row_count))
+            if row_count <= self._row_count:
+                return bool(deletions)
+
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(row_count, self.dimension)) if row_count else np.empty((0, self.dimension), dtype=np.float32)
+
+            new_rows = self._connection.execute(
+                "SELECT row, id, deleted FROM documents WHERE row >= ? AND row < ? ORDER BY row",
+                (self._row_count, row_count)
+            ).fetchall()
+
+            active_rows = np.zeros(row_count, dtype=bool)
+            active_rows[:len(self._active_rows)] = self._active_rows
+            for row, id, deleted in new_rows:
+                if not deleted:
+                    self._row_by_id[id] = row
+                    active_rows[row] = True
+            self._active_rows = active_rows
+            self._row_count = row_count
+
+            return True
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [os.urandom(16).hex() for _ in texts]
+
+        # Keep only the last chunk for every repeated ID
+        chunks_by_id = {id: (text, metadata) for id, text, metadata in zip(ids, texts, metadatas)}
+
+        vectors = _normalize(self._embedding.embed_documents([text for text, _ in chunks_by_id.values()]))
+
+        with self._lock:
+
+            # The SQLite write lock (BEGIN IMMEDIATE) is held while the row
+            # numbers are taken from the end of the vector file and the
+            # vectors are appended, so that the appends of other processes
+            # cannot interleave; a refresh only maps the vectors up to the
+            # last committed document row
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                # Chunks that are already stored (possibly by another
+                # process) are replaced by a new row
+                chunk_ids = list(chunks_by_id)
+                replaced_rows = []
+                for i in range(0, len(chunk_ids), 500):
+                    chunk_ids_batch = chunk_ids[i:i + 500]
+                    replaced_rows.extend(self._connection.execute(
+                        f"SELECT row, id FROM documents WHERE id IN ({','.join('?' * len(chunk_ids_batch))})",
+                        chunk_ids_batch
+                    ).fetchall())
+                self._delete_rows(replaced_rows)
+
+                first_row = os.path.getsize(self._vectors_path) // (4 * self.dimension)
+                self._connection.executemany(
+                    "INSERT INTO documents (row, id, text, metadata) VALUES (?, ?, ?, ?)",
+                    [(first_row + i, id, text, json.dumps(metadata)) for i, (id, (text, metadata)) in enumerate(chunks_by_id.items())]
+                )
+
+                with open(self._vectors_path, "ab") as f:
+                    f.write(vectors.tobytes())
+
+                self._connection.commit()
+            except BaseException:
+                self._connection.rollback()
+                raise
+
+            self._refresh(force=True)
+
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        if not ids:
+            return True
+
+        with self._lock:
+            self._refresh()
+
+            self._delete_rows([(self._row_by_id[id], id) for id in dict.fromkeys(ids) if id in self._row_by_id])
+            self._connection.commit()
+
+        return True
+
+    def get_existing_ids(self, ids):
+        self._refresh()
+        return {id for id in ids if id in self._row_by_id}
+
+    def get_ids_with_prefix(self, prefix):
+        self._refresh()
+        return {id for id in self._row_by_id if id.startswith(prefix)}
+
+    def get_documents(self, rows):
+        if not rows:
+            return []
+
+        documents_by_row = {}
+        for row, id, text, metadata in self._connection.execute(
+            f"SELECT row, id, text, metadata FROM documents WHERE row IN ({','.join('?' * len(rows))})",
+            [int(row) for row in rows]
+        ):
+            documents_by_row[row] = Document(id=id, page_content=text, metadata=json.loads(metadata))
+
+        return [documents_by_row[int(row)] for row in rows]
+
+    def get_by_ids(self, ids, /):
+        self._refresh()
+        return self.get_documents([self._row_by_id[id] for id in ids if id in self._row_by_id])
+
+    def get_vectors(self, rows):
+        return np.asarray(self._vectors[np.asarray(rows, dtype=np.int64)])
+
+    def search_rows(self, query_vector, k):
+
+        # Returns the rows and cosine similarities of the k nearest vectors
+        self._refresh()
+
+        if not self._active_rows.any():
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = self._vectors @ _normalize(query_vector)
+        scores = np.where(self._active_rows, scores, -np.inf)
+
+        k = min(k, int(self._active_rows.sum()))
+        top_rows = np.argpartition(-scores, k - 1)[:k]
+        top_rows = top_rows[np.argsort(-scores[top_rows])]
+
+        return top_rows, scores[top_rows]
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, **kwargs):
+        rows, scores = self.search_rows(embedding, k)
+        return list(zip(self.get_documents(rows.tolist()), scores.tolist()))
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k)
+
+    def _select_relevance_score_fn(self):
+        return lambda score: (score + 1) / 2
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        # Imported here since the mmr module imports this one
+        from mmr import maximal_marginal_relevance
+
+        rows, _ = self.search_rows(embedding, fetch_k)
+        selected = maximal_marginal_relevance(np.asarray(embedding, dtype=np.float32), self.get_vectors(rows), lambda_mult=lambda_mult, k=k)
+        return self.get_documents([int(rows[i]) for i in selected])
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        return self.max_marginal_relevance_search_by_vector(self._embedding.embed_query(query), k, fetch_k, lambda_mult)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, persist_directory=None, **kwargs):
+        store = cls(embedding, persist_directory, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+class HnswVectorStore(NumpyVectorStore):
+
+    # Approximate nearest neighbour search with an HNSW graph for larger
+    # corpora; the graph is saved next to the vectors, and rows appended
+    # since it was last saved are added to it when the store is refreshed
+
+    def __init__(self, embedding, persist_directory, dimension=1536, ef_search=64, ef_construction=200, m=16, save_interval=10000):
+        if hnswlib is None:
+            raise ImportError("The hnswlib package is required for the hnsw vector store backend; install it with: pip install hnswlib")
+
+        self._hnsw_index = None
+        self.ef_search = ef_search
+        self.ef_construction = ef_construction
+        self.m = m
+        self.save_interval = save_interval
+        self._saved_row_count = 0
+
+        # Rows that were active when the graph was last refreshed, so that
+        # only the rows deleted since then are marked as deleted
+        self._marked_active_rows = np.empty(0, dtype=bool)
+
+        super().__init__(embedding, persist_directory, dimension)
+
+    def _refresh(self, force=False):
+        with self._lock:
+            changed = super()._refresh(force)
+
+            if self._hnsw_index is None:
+                self._hnsw_index = hnswlib.Index(space="ip", dim=self.dimension)
+                hnsw_index_path = os.path.join(self.persist_directory, hnsw_index_file_name)
+                if os.path.exists(hnsw_index_path):
+                    self._hnsw_index.load_index(hnsw_index_path, max_elements=max(self._row_count, 1))
+                else:
+                    self._hnsw_index.init_index(max_elements=max(self._row_count, 1), ef_construction=self.ef_construction, M=self.m, allow_replace_deleted=False)
+                self._hnsw_index.set_ef(self.ef_search)
+                changed = True
+
+            if changed:
+                indexed_row_count = self._hnsw_index.get_current_count()
+                if indexed_row_count < self._row_count:
+                    # The capacity grows geometrically, since resizing
+                    # reallocates the whole graph
+                    max_elements = self._hnsw_index.get_max_elements()
+                    if self._row_count > max_elements:
+                        self._hnsw_index.resize_index(max(self._row_count, 2 * max_elements))
+                    new_rows = np.arange(indexed_row_count, self._row_count)
+                    self._hnsw_index.add_items(self.get_vectors(new_rows), new_rows)
+
+                self._mark_deleted_rows()
+
+            return changed
+
+    def _mark_deleted_rows(self):
+
+        # Marks the rows deleted since the graph was last marked, whether by
+        # this process or by another one
+        marked_active_rows = np.ones(self._row_count, dtype=bool)
+        marked_active_rows[:len(self._marked_active_rows)] = self._marked_active_rows
+        for row in np.flatnonzero(marked_active_rows & ~self._active_rows):
+            try:
+                self._hnsw_index.mark_deleted(int(row))
+            except RuntimeError:
+                pass
+        self._marked_active_rows = self._active_rows.copy()
+
+    def delete(self, ids=None, **kwargs):
+        with self._lock:
+            super().delete(ids)
+            self._mark_deleted_rows()
+        return True
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        ids = super().add_texts(texts, metadatas=metadatas, ids=ids, **kwargs)
+
+        # Save the graph every save interval rows, so that a restart only
+        # has to add the rows appended since the last save
+        if self._row_count - self._saved_row_count >= self.save_interval:
+            self.persist()
+
+        return ids
+
+    def persist(self):
+        with self._lock:
+            self._hnsw_index.save_index(os.path.join(self.persist_directory, hnsw_index_file_name))
+            self._saved_row_count = self._row_count
+
+    def search_rows(self, query_vector, k):
+        self._refresh()
+
+        active_row_count = int(self._active_rows.sum())
+        if not active_row_count:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        k = min(k, active_row_count)
+        self._hnsw_index.set_ef(max(self.ef_search, k))
+        rows, distances = self._hnsw_index.knn_query(_normalize(query_vector), k=k)
+
+        # The inner product distance is 1 - cosine similarity
+        return rows[0].astype(np.int64), (1 - distances[0]).astype(np.float32)
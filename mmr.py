@@ -0,0 +1,175 @@
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_pinecone import PineconeVectorStore
+from local_vector_store import NumpyVectorStore, _normalize
+from collections import OrderedDict
+import numpy as np
+import threading
+import time
+import os
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# Number of retrieved results kept in memory, and how long they are reused
+# before the vector store is queried again
+mmr_result_cache_size = int(os.getenv("RAG_RESULT_CACHE_SIZE", "256"))
+mmr_result_cache_ttl_seconds = float(os.getenv("RAG_RESULT_CACHE_TTL_SECONDS", "300"))
+
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+def maximal_marginal_relevance(query_vector, candidate_vectors, k=4, lambda_mult=0.5):
+
+    # Returns the indexes of the k candidates selected by maximal marginal
+    # relevance; the query similarities are computed with one matrix-vector
+    # product, and every step only computes the similarities to the newly
+    # selected candidate to update the running maximum similarity to the
+    # selection (instead of comparing every candidate with the whole
+    # selection again)
+    candidate_vectors = _normalize(candidate_vectors)
+    if len(candidate_vectors) == 0 or k <= 0:
+        return []
+
+    relevance_scores = candidate_vectors @ _normalize(query_vector)
+
+    selected = [int(np.argmax(relevance_scores))]
+    max_similarities = candidate_vectors @ candidate_vectors[selected[0]]
+    is_selected = np.zeros(len(candidate_vectors), dtype=bool)
+    is_selected[selected[0]] = True
+
+    while len(selected) < min(k, len(candidate_vectors)):
+        mmr_scores = lambda_mult * relevance_scores - (1 - lambda_mult) * max_similarities
+        mmr_scores[is_selected] = -np.inf
+
+        next_selected = int(np.argmax(mmr_scores))
+        selected.append(next_selected)
+        is_selected[next_selected] = True
+        np.maximum(max_similarities, candidate_vectors @ candidate_vectors[next_selected], out=max_similarities)
+
+    return selected
+
+def fetch_candidates(vector_store, query_vector, fetch_k):
+
+    # Returns the fetch_k nearest documents and their stored vectors,
+    # so that the candidates do not have to be embedded again
+    if isinstance(vector_store, NumpyVectorStore):
+        rows, _ = vector_store.search_rows(query_vector, fetch_k)
+        return vector_store.get_documents(rows.tolist()), vector_store.get_vectors(rows)
+
+    if isinstance(vector_store, PineconeVectorStore):
+        query_response = vector_store.index.query(
+            vector=list(query_vector),
+            top_k=fetch_k,
+            include_values=True,
+            include_metadata=True
+        )
+
+        documents = []
+        candidate_vectors = []
+        for match in query_response.matches:
+            metadata = dict(match.metadata or {})
+            text = metadata.pop("text", None)
+            if text is None:
+                continue
+            documents.append(Document(id=match.id, page_content=text, metadata=metadata))
+            candidate_vectors.append(match.values)
+
+        return documents, np.asarray(candidate_vectors, dtype=np.float32).reshape(len(candidate_vectors), -1)
+
+    documents = vector_store.similarity_search_by_vector(list(query_vector), k=fetch_k)
+    return documents, np.asarray(vector_store.embeddings.embed_documents([document.page_content for document in documents]), dtype=np.float32)
+
+def _get_cached_result(cache_key):
+    with _result_cache_lock:
+        cached_result = _result_cache.get(cache_key)
+        if cached_result is None:
+            return None
+
+        cached_time, documents = cached_result
+        if time.monotonic() - cached_time > mmr_result_cache_ttl_seconds:
+            del _result_cache[cache_key]
+            return None
+
+        _result_cache.move_to_end(cache_key)
+        return documents
+
+def _set_cached_result(cache_key, documents):
+    with _result_cache_lock:
+        _result_cache[cache_key] = (time.monotonic(), documents)
+        _result_cache.move_to_end(cache_key)
+        while len(_result_cache) > mmr_result_cache_size:
+            _result_cache.popitem(last=False)
+
+def clear_result_cache():
+
+    # Called when chunks are added to or deleted from the vector store, so
+    # that cached results do not outlive the chunks they were built from
+    # (changes made by other processes expire with the TTL)
+    with _result_cache_lock:
+        _result_cache.clear()
+
+class MMRRetriever(BaseRetriever):
+
+    # Retrieves fetch_k candidates from the vector store and re-ranks them
+    # with the vectorized maximal marginal relevance above; recent results
+    # are cached by query
+
+    vector_store: object
+    k: int = 4
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+
+    # When False, the candidates are embedded again instead of reusing
+    # the vectors returned by the vector store
+    reuse_candidate_embeddings: bool = True
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        cache_key = (id(self.vector_store), query, self.k, self.fetch_k, self.lambda_mult)
+
+        documents = _get_cached_result(cache_key)
+        if documents is not None:
+            return list(documents)
+
+        query_vector = self.vector_store.embeddings.embed_query(query)
+
+        candidate_documents, candidate_vectors = fetch_candidates(self.vector_store, query_vector, self.fetch_k)
+        if not self.reuse_candidate_embeddings and candidate_documents:
+            candidate_vectors = self.vector_store.embeddings.embed_documents([document.page_content for document in candidate_documents])
+
+        selected = maximal_marginal_relevance(query_vector, candidate_vectors, k=self.k, lambda_mult=self.lambda_mult)
+        documents = [candidate_documents[i] for i in selected]
+
+        _set_cached_result(cache_key, documents)
+
+        return list(documents)
+
+def run_benchmark():
+
+    # Compares the vectorized maximal marginal relevance with the LangChain
+    # implementation on random 1536-dimension candidates
+    from langchain_core.vectorstores.utils import maximal_marginal_relevance as langchain_maximal_marginal_relevance
+
+    rng = np.random.default_rng(0)
+    repeats = 20
+
+    for fetch_k in (20, 100, 500):
+        for k in (4, 10):
+            query_vector = rng.standard_normal(1536).astype(np.float32)
+            candidate_vectors = rng.standard_normal((fetch_k, 1536)).astype(np.float32)
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                selected = maximal_marginal_relevance(query_vector, candidate_vectors, k=k, lambda_mult=0.7)
+            vectorized_ms = (time.perf_counter() - start) * 1000 / repeats
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                langchain_selected = langchain_maximal_marginal_relevance(query_vector, list(candidate_vectors), lambda_mult=0.7, k=k)
+            langchain_ms = (time.perf_counter() - start) * 1000 / repeats
+
+            print(f"fetch_k={fetch_k:4d} k={k:2d}: vectorized {vectorized_ms:7.3f} ms, langchain {langchain_ms:7.3f} ms, same selection: {selected == list(langchain_selected)}")
+
+if __name__ == "__main__":
+    run_benchmark()
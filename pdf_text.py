@@ -0,0 +1,372 @@
+from pypdf import PdfReader
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# Directory of the on-disk PDF text store, and the maximum number of bytes
+# it may grow to before the least recently used entries are evicted
+pdf_text_cache_dir = os.getenv("PDF_TEXT_CACHE_DIR", os.path.join(".cache", "pdf_text"))
+pdf_text_cache_max_bytes = int(os.getenv("PDF_TEXT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Maximum number of PDFs whose extracted text is kept in process memory
+pdf_text_cache_memory_entries = int(os.getenv("PDF_TEXT_CACHE_MEMORY_ENTRIES", "32"))
+
+# Maximum number of characters of page text kept for the cache while the
+# pages of a PDF are streamed; past it, only the pages before it are cached,
+# so that streaming memory does not grow with the length of the document
+pdf_text_cache_stream_max_chars = int(os.getenv("PDF_TEXT_CACHE_STREAM_MAX_CHARS", str(8 * 1024 * 1024)))
+
+# Number of worker processes used to extract the text of large PDFs, and the
+# minimum number of pages before extraction is split across the workers
+pdf_extraction_workers = int(os.getenv("PDF_EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+pdf_parallel_min_pages = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "32"))
+
+# Number of pages extracted at a time when the pages of a PDF are streamed
+pdf_stream_window_pages = int(os.getenv("PDF_STREAM_WINDOW_PAGES", "64"))
+
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()
+_disk_cache_lock = threading.Lock()
+_extraction_executor = None
+_extraction_executor_lock = threading.Lock()
+
+# PDF reader kept by every extraction worker process for the document being
+# streamed, keyed by the temporary file path and the PDF hash
+_worker_pdf_key = None
+_worker_pdf_reader = None
+
+def read_pdf_bytes(pdf_file):
+
+    # Accept raw bytes, a file path, a Streamlit UploadedFile, or any other
+    # binary file-like object
+    if isinstance(pdf_file, (bytes, bytearray)):
+        return bytes(pdf_file)
+
+    if isinstance(pdf_file, (str, os.PathLike)):
+        with open(pdf_file, "rb") as f:
+            return f.read()
+
+    if hasattr(pdf_file, "getvalue"):
+        return pdf_file.getvalue()
+
+    pdf_file.seek(0)
+    pdf_bytes = pdf_file.read()
+    pdf_file.seek(0)
+
+    return pdf_bytes
+
+def get_pdf_hash(pdf_bytes):
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+def normalize_page_text(page_text):
+    # Remove all the new line characters and repeated whitespaces to save tokens
+    return ' '.join((page_text or "").split())
+
+def _get_extraction_executor():
+    global _extraction_executor
+
+    with _extraction_executor_lock:
+        if _extraction_executor is None:
+            # The "spawn" start method is used because forking the
+            # multi-threaded Streamlit server process is unsafe, and
+            # because it is the only start method available on Windows
+            _extraction_executor = ProcessPoolExecutor(
+                max_workers=pdf_extraction_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _extraction_executor
+
+def _reset_extraction_executor():
+    global _extraction_executor
+
+    with _extraction_executor_lock:
+        if _extraction_executor is not None:
+            _extraction_executor.shutdown(wait=False, cancel_futures=True)
+        _extraction_executor = None
+
+def _extract_page_range(pdf_bytes, start, stop):
+
+    # Runs inside a worker process, so the PDF is re-opened from its bytes
+    pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+
+    return [normalize_page_text(pdf_reader.pages[i].extract_text()) for i in range(start, stop)]
+
+def _extract_page_range_from_file(pdf_path, pdf_hash, start, stop):
+    global _worker_pdf_key, _worker_pdf_reader
+
+    # Runs inside a worker process; the streamed PDF is read from its
+    # temporary file and parsed once per worker, and the reader is reused
+    # for the next windows of the same document
+    if _worker_pdf_key != (pdf_path, pdf_hash):
+        with open(pdf_path, "rb") as f:
+            _worker_pdf_reader = PdfReader(io.BytesIO(f.read()))
+        _worker_pdf_key = (pdf_path, pdf_hash)
+
+    return [normalize_page_text(_worker_pdf_reader.pages[i].extract_text()) for i in range(start, stop)]
+
+def _split_page_range(start, stop, range_count):
+    page_count = stop - start
+    range_size, remainder = divmod(page_count, range_count)
+
+    page_ranges = []
+    range_start = start
+    for i in range(range_count):
+        range_stop = range_start + range_size + (1 if i < remainder else 0)
+        if range_stop > range_start:
+            page_ranges.append((range_start, range_stop))
+        range_start = range_stop
+
+    return page_ranges
+
+def extract_pdf_pages(pdf_bytes, start, stop):
+
+    # Small documents (or a single worker) are extracted in-process, since
+    # starting the work in another process costs more than it saves
+    if pdf_extraction_workers <= 1 or stop - start < pdf_parallel_min_pages:
+        return _extract_page_range(pdf_bytes, start, stop)
+
+    # Split the page range into one contiguous range per worker, and
+    # reassemble the extracted text in page order
+    page_ranges = _split_page_range(start, stop, pdf_extraction_workers)
+
+    try:
+        executor = _get_extraction_executor()
+        futures = [executor.submit(_extract_page_range, pdf_bytes, range_start, range_stop) for range_start, range_stop in page_ranges]
+
+        pages = []
+        for future in futures:
+            pages.extend(future.result())
+
+        return pages
+
+    except BrokenProcessPool:
+        print("The PDF extraction process pool stopped unexpectedly; extracting in-process instead.")
+        _reset_extraction_executor()
+        return _extract_page_range(pdf_bytes, start, stop)
+
+def _extract_pdf_window(pdf_reader, pdf_path, pdf_hash, start, stop):
+
+    # Extracts a window of the streamed PDF: in-process with the reader of
+    # the stream, or split across the workers, which read the PDF from its
+    # temporary file (instead of receiving the PDF bytes with every window)
+    if pdf_path is None:
+        return [normalize_page_text(pdf_reader.pages[i].extract_text()) for i in range(start, stop)]
+
+    try:
+        executor = _get_extraction_executor()
+        futures = [
+            executor.submit(_extract_page_range_from_file, pdf_path, pdf_hash, range_start, range_stop)
+            for range_start, range_stop in _split_page_range(start, stop, pdf_extraction_workers)
+        ]
+
+        pages = []
+        for future in futures:
+            pages.extend(future.result())
+
+        return pages
+
+    except BrokenProcessPool:
+        print("The PDF extraction process pool stopped unexpectedly; extracting in-process instead.")
+        _reset_extraction_executor()
+        return [normalize_page_text(pdf_reader.pages[i].extract_text()) for i in range(start, stop)]
+
+def _get_memory_entry(pdf_hash):
+    with _memory_cache_lock:
+        entry = _memory_cache.get(pdf_hash)
+        if entry is not None:
+            _memory_cache.move_to_end(pdf_hash)
+        return entry
+
+def _set_memory_entry(pdf_hash, entry):
+    with _memory_cache_lock:
+        _memory_cache[pdf_hash] = entry
+        _memory_cache.move_to_end(pdf_hash)
+        while len(_memory_cache) > pdf_text_cache_memory_entries:
+            _memory_cache.popitem(last=False)
+
+def _get_disk_entry_path(pdf_hash):
+    return os.path.join(pdf_text_cache_dir, pdf_hash + ".json")
+
+def _get_disk_entry(pdf_hash):
+    entry_path = _get_disk_entry_path(pdf_hash)
+
+    try:
+        with open(entry_path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # Refresh the modification time so that eviction is least recently used
+    try:
+        os.utime(entry_path)
+    except OSError:
+        pass
+
+    return entry
+
+def _set_disk_entry(pdf_hash, entry):
+    with _disk_cache_lock:
+        try:
+            os.makedirs(pdf_text_cache_dir, exist_ok=True)
+
+            # Write to a uniquely named temporary file first so that a
+            # concurrent reader never sees a partially written entry, and
+            # two processes writing the same entry never share a file
+            entry_path = _get_disk_entry_path(pdf_hash)
+            temporary_file, temporary_entry_path = tempfile.mkstemp(dir=pdf_text_cache_dir, prefix=pdf_hash + ".", suffix=".tmp")
+            try:
+                with os.fdopen(temporary_file, "w", encoding="utf-8") as f:
+                    json.dump(entry, f, ensure_ascii=False)
+                os.replace(temporary_entry_path, entry_path)
+            except BaseException:
+                try:
+                    os.remove(temporary_entry_path)
+                except OSError:
+                    pass
+                raise
+
+            _evict_disk_entries()
+        except OSError as e:
+            print(f"Could not write the PDF text cache entry {pdf_hash}: {e}")
+
+def _evict_disk_entries():
+    entries = []
+    total_size = 0
+
+    for file_name in os.listdir(pdf_text_cache_dir):
+        if not file_name.endswith(".json"):
+            continue
+        entry_stat = os.stat(os.path.join(pdf_text_cache_dir, file_name))
+        entries.append((entry_stat.st_mtime, entry_stat.st_size, file_name))
+        total_size += entry_stat.st_size
+
+    # Remove the least recently used entries until the store fits its budget
+    entries.sort()
+    for _, entry_size, file_name in entries:
+        if total_size <= pdf_text_cache_max_bytes:
+            break
+        os.remove(os.path.join(pdf_text_cache_dir, file_name))
+        total_size -= entry_size
+
+def _get_cached_entry(pdf_hash):
+    entry = _get_memory_entry(pdf_hash)
+
+    if entry is None:
+        entry = _get_disk_entry(pdf_hash)
+        if entry is not None:
+            _set_memory_entry(pdf_hash, entry)
+
+    return entry
+
+def get_pdf_pages(pdf_file, max_pages=None):
+
+    # Returns the normalized text of every PDF page (or only of the first
+    # max_pages pages); the text is cached by the SHA-256 hash of the PDF
+    # bytes, so summarizing, citing, and uploading the same file only
+    # parses each page once
+    pdf_bytes = read_pdf_bytes(pdf_file)
+    pdf_hash = get_pdf_hash(pdf_bytes)
+
+    entry = _get_cached_entry(pdf_hash)
+
+    if entry is not None:
+        pages_needed = entry["page_count"] if max_pages is None else min(max_pages, entry["page_count"])
+        if len(entry["pages"]) >= pages_needed:
+            return entry["pages"][:pages_needed]
+
+    pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+    page_count = len(pdf_reader.pages)
+    pages_needed = page_count if max_pages is None else min(max_pages, page_count)
+
+    # Pages are always extracted as a prefix of the document, so a cached
+    # entry created for a citation (first page only) is extended, not
+    # re-extracted, when the whole document is needed later
+    pages = list(entry["pages"]) if entry is not None else []
+    pages.extend(extract_pdf_pages(pdf_bytes, len(pages), pages_needed))
+
+    entry = {"page_count": page_count, "pages": pages}
+
+    _set_memory_entry(pdf_hash, entry)
+    _set_disk_entry(pdf_hash, entry)
+
+    return pages
+
+def iter_pdf_pages(pdf_file, use_cache=True):
+
+    # Yields the normalized text of the PDF pages in order, extracting a
+    # window of pages at a time, so that the first pages can be processed
+    # before the whole document has been parsed; bulk ingestion passes
+    # use_cache=False, so that it neither reads nor fills the text cache of
+    # the PDFs uploaded in the app
+    pdf_bytes = read_pdf_bytes(pdf_file)
+    pdf_hash = get_pdf_hash(pdf_bytes)
+
+    entry = _get_cached_entry(pdf_hash) if use_cache else None
+
+    if entry is not None:
+        yield from entry["pages"]
+        if len(entry["pages"]) >= entry["page_count"]:
+            return
+
+    pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+    page_count = len(pdf_reader.pages)
+
+    cached_page_count = len(entry["pages"]) if entry is not None else 0
+
+    # The pages kept for the cache form a prefix of the document (like the
+    # first page cached for a citation), which stops growing at the stream
+    # max chars
+    pages = list(entry["pages"]) if entry is not None else []
+    pages_chars = sum(len(page) for page in pages)
+    keeping_pages = use_cache and pages_chars <= pdf_text_cache_stream_max_chars
+
+    # Large documents are extracted by the worker processes from a
+    # temporary copy of the PDF, which every worker parses only once
+    pdf_path = None
+    if pdf_extraction_workers > 1 and page_count - cached_page_count >= pdf_parallel_min_pages:
+        pdf_file_descriptor, pdf_path = tempfile.mkstemp(suffix=".pdf")
+        with os.fdopen(pdf_file_descriptor, "wb") as f:
+            f.write(pdf_bytes)
+
+    try:
+        for window_start in range(cached_page_count, page_count, pdf_stream_window_pages):
+            window_stop = min(window_start + pdf_stream_window_pages, page_count)
+            window_pages = _extract_pdf_window(pdf_reader, pdf_path, pdf_hash, window_start, window_stop)
+
+            for page in window_pages:
+                if keeping_pages and pages_chars + len(page) <= pdf_text_cache_stream_max_chars:
+                    pages.append(page)
+                    pages_chars += len(page)
+                else:
+                    keeping_pages = False
+
+            yield from window_pages
+
+    finally:
+        if pdf_path is not None:
+            try:
+                os.remove(pdf_path)
+            except OSError:
+                pass
+
+    # The page text is only added to the cache once the pages have been
+    # extracted; the cache itself is bounded by its own size limits
+    if len(pages) > cached_page_count:
+        entry = {"page_count": page_count, "pages": pages}
+
+        _set_memory_entry(pdf_hash, entry)
+        _set_disk_entry(pdf_hash, entry)
+
+def get_pdf_text(pdf_file, max_pages=None):
+    return "".join(get_pdf_pages(pdf_file, max_pages=max_pages))
@@ -1,9 +1,9 @@
-from pinecone import Pinecone, ServerlessSpec
-from langchain_openai.embeddings import OpenAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
-import time
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough
+from vector_store import get_pdf_vector_store
+from mmr import MMRRetriever
+from sparse_index import HybridRetriever, get_sparse_index, sparse_index_enabled
+import functools
 # import streamlit as st
 import os
 from dotenv import load_dotenv
@@ -11,64 +11,16 @@ from dotenv import load_dotenv
 if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
     load_dotenv()
 
-openai_api_key = os.getenv("OPENAI_API_KEY")
-pinecone_api_key = os.getenv("PINECONE_API_KEY")
+# Tunables of the maximum marginal relevance retrieval
+rag_k = int(os.getenv("RAG_K", "4"))
+rag_fetch_k = int(os.getenv("RAG_FETCH_K", "20"))
+rag_lambda_mult = float(os.getenv("RAG_LAMBDA_MULT", "0.7"))
 
-def generate_rag_runnable_chain():
-
-    pc = Pinecone(api_key=pinecone_api_key)
-
-    index_name = "pdf-index"
-
-    if not pc.has_index(index_name):
-        pc.create_index(
-            name=index_name,
-            # Dimension has been set to 1536 to match OpenAI's "text-embedding-3-small" embedding algorithm
-            dimension=1536,
-            metric="cosine",
-            spec=ServerlessSpec(
-                cloud='aws',
-                region='us-east-1'
-            )
-        )
-        while not pc.describe_index(index_name).status["ready"]:
-            time.sleep(1)
-
-
-    embedding = OpenAIEmbeddings(model = "text-embedding-3-small", openai_api_key=openai_api_key)
-
-    index = pc.Index(index_name)
-
-    pc_vector_store = PineconeVectorStore(index=index, embedding=embedding)
-
-    retriever = pc_vector_store.as_retriever(
-
-        # The maximum marginal relevance (mmr) search is like the similarity search
-        # except that it make sure that duplicate/overly-similar/redundant
-        # results are not returned from the database; result diversity can be
-        # improved with maximum marginal relevance search (compared with
-        # plain similarity searching)
-        search_type = 'mmr', 
-
-        # The lambda multiplication factor controls the diversity of results;
-        # the scale goes from 0 to 1; 0 is most diverse; 1 is least diverse;
-        # setting to 1 would be equivalent to a similarity search
-        search_kwargs = {
-
-            # Number of Documents to return. Defaults to 4.
-            'k':4, 
+# Number of results taken from each of the vector and the BM25 rankings
+# before they are fused into the final k results
+rag_hybrid_candidates = int(os.getenv("RAG_HYBRID_CANDIDATES", "10"))
 
-            # The lambda multiplication factor controls the diversity of results;
-            # the scale goes from 0 to 1; 0 is most diverse; 1 is least diverse;
-            # setting to 1 would be equivalent to a similarity search
-            'lambda_mult':0.7
-
-            # optonal filter parameter to filter by a metadata value
-            # filter = {"metadata key": "metadata value"}
-            }
-        )
-
-    TEMPLATE = '''You are a scientific expert that can communicate simply, clearly, and concisely.
+TEMPLATE = '''You are a scientific expert that can communicate simply, clearly, and concisely.
 
 Provide a detailed answer for the following question:
 {question}
@@ -87,7 +39,48 @@ where *Citations* should be substituted with the citations as an alphabetically
 If no resource in the context is used, then do not include the "FOSRC References" section.
 '''
 
-    prompt_template = PromptTemplate.from_template(TEMPLATE)
+prompt_template = PromptTemplate.from_template(TEMPLATE)
+
+# The chain is built once per process and reused by every RAG tool call, so
+# that each call only pays for the retrieval query itself
+@functools.lru_cache(maxsize=1)
+def generate_rag_runnable_chain():
+
+    pc_vector_store = get_pdf_vector_store()
+
+    # The maximum marginal relevance (mmr) search is like the similarity search
+    # except that it make sure that duplicate/overly-similar/redundant
+    # results are not returned from the database; result diversity can be
+    # improved with maximum marginal relevance search (compared with
+    # plain similarity searching); the fetch_k nearest candidates are
+    # re-ranked locally with the vectors returned by the database
+    retriever = MMRRetriever(
+        vector_store = pc_vector_store,
+
+        # Number of Documents to return. Defaults to 4; more are returned
+        # when they are fused with the BM25 results below
+        k = max(rag_k, rag_hybrid_candidates) if sparse_index_enabled else rag_k,
+
+        # Number of candidate Documents fetched from the database
+        # for the maximum marginal relevance re-ranking
+        fetch_k = rag_fetch_k,
+
+        # The lambda multiplication factor controls the diversity of results;
+        # the scale goes from 0 to 1; 0 is most diverse; 1 is least diverse;
+        # setting to 1 would be equivalent to a similarity search
+        lambda_mult = rag_lambda_mult
+        )
+
+    # Fuse the vector results with the BM25 keyword results using
+    # reciprocal rank fusion, so that exact terms (species names, program
+    # acronyms, report numbers) missed by the vector search are still found
+    if sparse_index_enabled:
+        retriever = HybridRetriever(
+            dense_retriever = retriever,
+            sparse_index = get_sparse_index(),
+            k = rag_k,
+            sparse_k = rag_hybrid_candidates
+            )
 
     chain = ({'context': retriever, 
             'question': RunnablePassthrough()} 
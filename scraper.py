@@ -1,196 +1,322 @@
 
 import requests
-from pinecone import Pinecone, ServerlessSpec
-from langchain_text_splitters.character import CharacterTextSplitter
-from langchain_openai.embeddings import OpenAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
+from chunking import get_chunking_signature, iter_token_chunks
 # import streamlit as st
-import time
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
+from driver_pool import ChromeDriverPool, resolve_chrome_driver_path
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 import os
 from dotenv import load_dotenv
 import asyncio
+import math
 from concurrent.futures import ThreadPoolExecutor
+from vector_store import add_new_texts, delete_texts, get_pdf_vector_store, persist_vector_store
+from crawl_ledger import get_content_hash, get_crawl_ledger
+from sitemap import iter_sitemap_urls
+from crawl_scheduler import CrawlScheduler, crawl_url_timeout_seconds, get_lastmod_priority
 
 # from selenium.webdriver.edge.service import Service as EdgeService
 # from webdriver_manager.microsoft import EdgeChromiumDriverManager
 
-from bs4 import BeautifulSoup
+from dspace_client import get_dspace_client
+from html_extract import extract_page_in_process
 
 if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
     load_dotenv()
 
-openai_api_key = os.getenv("OPENAI_API_KEY")
-pinecone_api_key = os.getenv("PINECONE_API_KEY")
 fosrc_server_link = os.getenv("FOSRC_SERVER_LINK")
 
-class ScrapedWebPage:
-    def __init__(self, url):
-
-        self.url = url
+# Number of web pages scraped at the same time (and of pooled Chrome
+# drivers), and the number of sitemap web pages to scrape (the most recent
+# ones); a limit of 0 scrapes every web page in the sitemap
+scraper_workers = int(os.getenv("SCRAPER_WORKERS", "5"))
+scraper_url_limit = int(os.getenv("SCRAPER_URL_LIMIT", "0"))
+
+# Number of scraped web pages chunked, embedded and upserted at the same
+# time, and the maximum number of URLs (and of scraped web pages) waiting
+# between the pipeline stages
+scraper_upload_workers = int(os.getenv("SCRAPER_UPLOAD_WORKERS", "2"))
+scraper_queue_size = int(os.getenv("SCRAPER_QUEUE_SIZE", str(scraper_workers * 2)))
+
+# Maximum number of discovered URLs waiting to be scraped, among which the
+# most recently modified web pages are scraped first
+scraper_priority_window = int(os.getenv("SCRAPER_PRIORITY_WINDOW", "1000"))
+
+# Number of discovered sitemap web pages recorded in the crawl ledger at once
+sitemap_entry_batch_size = 100
+
+# The web pages are fetched with plain (pooled) HTTP first, and only
+# rendered with Selenium when the server-rendered HTML does not contain the
+# item selector; Selenium waits up to the page timeout for the selector
+scraper_http_fast_path = os.getenv("SCRAPER_HTTP_FAST_PATH", "true").lower() == "true"
+scraper_item_selector = os.getenv("SCRAPER_ITEM_SELECTOR", "ds-item-page h1")
+scraper_page_timeout_seconds = float(os.getenv("SCRAPER_PAGE_TIMEOUT_SECONDS", "15"))
+
+# Longest time one attempt at a URL can take: the HTTP request (connect and
+# read timeouts), the page load, and the wait for the item selector; the URL
+# timeout of the crawl scheduler is kept longer than it, so that an attempt
+# is never abandoned while its thread and driver are still working
+scraper_attempt_max_seconds = 4 * scraper_page_timeout_seconds
+
+def fetch_page_http(url):
+
+    # Returns the server-rendered HTML (bytes, so that the parser detects the
+    # encoding), or None when the request fails
+    try:
+        response = get_dspace_client().get(url, timeout=scraper_page_timeout_seconds)
+    except requests.RequestException as e:
+        print(f"HTTP request failed for URL {url}: {e}")
+        return None
+
+    if response.status_code != 200:
+        return None
+
+    return response.content
+
+def fetch_page_selenium(url, driver_pool):
+
+    # Check out a long-lived headless Chrome driver from the pool
+    # instead of starting a new browser for every page
+    with driver_pool.checkout() as driver:
+
+        # Start Selenium WebDriver; the page load is bounded by the page
+        # timeout of the pooled drivers, and a page that is still loading is
+        # used as far as it has been rendered
+        try:
+            driver.get(url)
+        except TimeoutException:
+            print(f"Timed out loading URL: {url}")
+
+        # Wait until the item content has been rendered by JS (or until the
+        # timeout, in which case whatever has been rendered is used)
+        try:
+            WebDriverWait(driver, scraper_page_timeout_seconds).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, scraper_item_selector))
+            )
+        except TimeoutException:
+            print(f"Timed out waiting for the item content of URL: {url}")
 
-        # Configure headless Chrome
-        options = Options()
-        options.add_argument('--headless')
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
+        # Fetch the page source after JS execution
+        return driver.page_source
 
-        # Use webdriver-manager to manage ChromeDriver
-        service = Service(ChromeDriverManager().install())
+class ScrapedWebPage:
+    def __init__(self, url, driver_pool):
 
-        # Initialize the Chrome WebDriver with the service and options
-        driver = webdriver.Chrome(service=service, options=options)
+        self.url = url
 
         print(f"Start scraping URL: {self.url}")
 
-        # Start Selenium WebDriver
-        driver.get(self.url)
-
-        # Wait for JS to load (adjust as needed)
-        time.sleep(2)
+        # The title and the main text are extracted in the extraction process
+        # pool (see html_extract.py); the server-rendered HTML is only used
+        # when it contains the item body, otherwise the page is rendered
+        # with Selenium
+        extracted_page = None
 
-        # Fetch the page source after JS execution
-        page_source = driver.page_source
-        driver.quit()
-
-        # Parse the HTML content with BeautifulSoup
-        soup = BeautifulSoup(page_source, 'html.parser')
-
-        # Extract title
-        self.title = soup.find('h1').get_text() if soup.find('h1') else soup.title.string if soup.title else "No title"
-
-        # Remove all trailing and leading whitespaces, and new line
-        # characters from p elements
-        for paragraph_elem in soup.find_all('p'):
-            modified_paragraph_text = paragraph_elem.get_text(separator=" ", strip=True)
-            paragraph_elem.replace_with(modified_paragraph_text)
+        if scraper_http_fast_path:
+            page_html = fetch_page_http(self.url)
+            if page_html is not None:
+                extracted_page = extract_page_in_process(page_html, scraper_item_selector)
+                if not extracted_page[2] or not extracted_page[1]:
+                    extracted_page = None
 
-        # Remove unnecessary elements
-        for irrelevant in soup.body(["script", "style", "img", "input", "footer", "header", "nav", "ds-search-results"]):
-            irrelevant.decompose()
+        if extracted_page is None:
+            extracted_page = extract_page_in_process(fetch_page_selenium(self.url, driver_pool))
 
-        # Extract the main text
-        self.text = soup.body.get_text(separator="\n", strip=True)
+        self.title, self.text, _ = extracted_page
 
         print(f"Finished scraping URL: {self.url}")
 
-def scrape_web_page_sync(url: str):
-    return ScrapedWebPage(url)
+def scrape_web_page_sync(url: str, driver_pool: ChromeDriverPool):
+    return ScrapedWebPage(url, driver_pool)
 
-async def scrape_web_page_async(url, loop):
-        
-    executor = ThreadPoolExecutor(max_workers=5) # Adjust max_workers as needed
+async def scrape_web_page_async(url, crawl_scheduler, driver_pool):
 
     """Asynchronously schedules a synchronous Selenium scraping task."""
-    return await loop.run_in_executor(executor, scrape_web_page_sync, url)
+    return await crawl_scheduler.run(url, scrape_web_page_sync, url, driver_pool)
 
-async def upload_all_scraped_webpages(scraped_web_pages_list: list[ScrapedWebPage]):
+async def upload_scraped_web_page(scraped_web_page: ScrapedWebPage, pc_vector_store):
 
-    print(f"Starting upload to Pinecone.")
+    # Splitting the original web page text into chunks of whole sentences
+    # within the token budget of web pages
+    char_split_text = list(iter_token_chunks([scraped_web_page.text], "web"))
 
-    pc = Pinecone(api_key=pinecone_api_key)
+    print(f"Uploading the following to Pinecone: {scraped_web_page.title}")
 
-    index_name = "pdf-index"
-
-    if not pc.has_index(index_name):
-        pc.create_index(
-            name=index_name,
-            # Dimension has been set to 1536 to match OpenAI's "text-embedding-3-small" embedding algorithm
-            dimension=1536,
-            metric="cosine",
-            spec=ServerlessSpec(
-                cloud='aws',
-                region='us-east-1'
-            )
-        )
-        while not pc.describe_index(index_name).status["ready"]:
-            time.sleep(1)
-
-    # Initializing the character splitter, and defining how you want
-    #  split text up in a document
-    char_splitter = CharacterTextSplitter(
-        # Setting the separator to "." to separate at the end of a sentence, and
-        # to not end the chunk before a sentence finishes
-        separator = ".",
-        chunk_size = 10000,
-        chunk_overlap  = 0
+    # The vector IDs are derived from the URL and the chunk text, so
+    # re-running the scraper only embeds and stores new or changed chunks
+    return await asyncio.to_thread(
+        add_new_texts,
+        pc_vector_store,
+        texts=char_split_text,
+        metadatas=[{"url": scraped_web_page.url, "title": scraped_web_page.title} for _ in range(len(char_split_text))],
+        source_id=scraped_web_page.url
     )
 
-    embedding = OpenAIEmbeddings(model = "text-embedding-3-small", openai_api_key=openai_api_key)
-
-    index = pc.Index(index_name)
-    
-    tasks = []
-
-    for scraped_web_page in scraped_web_pages_list:
-
-        pc_vector_store = PineconeVectorStore(index=index, embedding=embedding)
-
-        # Splitting the original web page text into chunks of text
-        char_split_text = char_splitter.split_text(scraped_web_page.text)
-
-        print(f"Uploading the following to Pinecone: {scraped_web_page.title}")
-
-        tasks.append(pc_vector_store.aadd_texts(
-            texts=char_split_text,
-            metadatas=[{"url": scraped_web_page.url, "title": scraped_web_page.title} for _ in range(len(char_split_text))]
-        ))
-
-    await asyncio.gather(*tasks)
-    print(f"All scraped webpages uploaded to Pinecone.")
+async def run_scrape_pipeline(sitemap_entries, driver_pool, crawl_scheduler, crawl_ledger, run_id):
+
+    # Streams the (url, lastmod) sitemap entries (an async iterator) through
+    # the scraping workers and the scraped web pages through the upload
+    # workers; both queues are bounded, so only a few web pages are held in
+    # memory, and every worker picks up the next URL (or web page) as soon as
+    # it is done, instead of waiting for the slowest web page of a group
+
+    # The queued URLs are scraped by priority, the most recently modified
+    # web pages first
+    url_queue = asyncio.PriorityQueue(maxsize=scraper_priority_window)
+    page_queue = asyncio.Queue(maxsize=scraper_queue_size)
+
+    pc_vector_store = get_pdf_vector_store()
+
+    counts = {"scraped": 0, "unchanged": 0, "uploaded": 0, "failed": 0}
+
+    async def produce_urls():
+        sequence = 0
+        async for url, lastmod in sitemap_entries:
+            sequence += 1
+            await url_queue.put((get_lastmod_priority(lastmod), sequence, url))
+
+        # The stop markers are queued after every URL
+        for _ in range(scraper_workers):
+            sequence += 1
+            await url_queue.put((math.inf, sequence, None))
+
+    async def scrape_worker():
+        while (url := (await url_queue.get())[2]) is not None:
+            try:
+                scraped_web_page = await scrape_web_page_async(url, crawl_scheduler, driver_pool)
+            except Exception as e:
+                counts["failed"] += 1
+                crawl_ledger.mark_failed(url, run_id)
+                print(f"Scraping failed for URL {url}: {e}")
+                continue
+
+            counts["scraped"] += 1
+
+            # Web pages whose content (and chunk settings) have not changed
+            # since they were ingested are not chunked and uploaded again
+            content_hash = get_content_hash(scraped_web_page.title, scraped_web_page.text, get_chunking_signature("web"))
+            if crawl_ledger.is_unchanged(url, content_hash):
+                counts["unchanged"] += 1
+                crawl_ledger.mark_unchanged(url, run_id)
+                continue
+
+            await page_queue.put((scraped_web_page, content_hash))
+
+    async def upload_worker():
+        while (queued_web_page := await page_queue.get()) is not None:
+            scraped_web_page, content_hash = queued_web_page
+            try:
+                vector_ids = await upload_scraped_web_page(scraped_web_page, pc_vector_store)
+
+                # The vectors of the previous version of the web page that
+                # are not part of the new version are deleted
+                stale_vector_ids = crawl_ledger.mark_done(scraped_web_page.url, content_hash, vector_ids, run_id)
+                await asyncio.to_thread(delete_texts, pc_vector_store, stale_vector_ids)
+            except Exception as e:
+                counts["failed"] += 1
+                crawl_ledger.mark_failed(scraped_web_page.url, run_id)
+                print(f"Upload failed for URL {scraped_web_page.url}: {e}")
+                continue
+
+            counts["uploaded"] += 1
+            print(f"Completed {counts['uploaded']} web pages.")
+
+    upload_tasks = [asyncio.create_task(upload_worker()) for _ in range(scraper_upload_workers)]
+
+    try:
+        await asyncio.gather(produce_urls(), *[scrape_worker() for _ in range(scraper_workers)])
+
+        # Stop the upload workers once every scraped web page is queued
+        for _ in range(scraper_upload_workers):
+            await page_queue.put(None)
+        await asyncio.gather(*upload_tasks)
+
+    finally:
+        for upload_task in upload_tasks:
+            upload_task.cancel()
+
+    persist_vector_store()
+    print(f"All scraped webpages uploaded to Pinecone ({counts['unchanged']} unchanged, {counts['failed']} failed).")
+    print(f"Crawl stats: {crawl_scheduler.format_stats()}")
+
+    return counts
+
+async def iter_sitemap_entry_batches():
+
+    # Yields the (url, lastmod) of the sitemap web pages in batches, as they
+    # are discovered by the sitemap walker
+    sitemap_entries = iter_sitemap_urls(fosrc_server_link)
+
+    # Only scrape the last sitemap children web pages when a limit is set
+    # (e.g. SCRAPER_URL_LIMIT=50 for testing purposes)
+    if scraper_url_limit > 0:
+        yield [entry async for entry in sitemap_entries][-scraper_url_limit:]
+        return
+
+    sitemap_entry_batch = []
+    async for entry in sitemap_entries:
+        sitemap_entry_batch.append(entry)
+        if len(sitemap_entry_batch) >= sitemap_entry_batch_size:
+            yield sitemap_entry_batch
+            sitemap_entry_batch = []
+
+    if sitemap_entry_batch:
+        yield sitemap_entry_batch
+
+async def iter_pending_sitemap_entries(crawl_ledger, run_id):
+
+    # Record the sitemap web pages in the crawl ledger, and only pass on the
+    # new or changed ones (and the ones left over by an interrupted run) to
+    # the scraping workers, while the sitemap is still being walked
+    discovered_count = 0
+    pending_count = 0
+
+    async for sitemap_entry_batch in iter_sitemap_entry_batches():
+        crawl_ledger.mark_seen(sitemap_entry_batch, run_id)
+        discovered_count += len(sitemap_entry_batch)
+
+        for url, lastmod in sitemap_entry_batch:
+            if crawl_ledger.needs_processing(url, run_id):
+                pending_count += 1
+                yield url, lastmod
+
+    print(f"{pending_count} of {discovered_count} web pages are new, changed or pending.")
 
 async def main():
 
-    parent_sitemap_response = requests.get(fosrc_server_link + '/sitemap_index.html')
-
-    #BeautifulSoup allows us to parse html; in other words, 
-    # we can use beautiful soup to convert a html string value
-    # to html objects (contained within a BeautifulSoup
-    # instance)
-
-    # Passing the html string value and 'html.parser' to the 
-    # BeautifulSoup() class to create a BeautifulSoup instance
-    # with the parsed html
-    # Note that 'html.parser' is one of many different parsers
-    # you can use with BeautifulSoup
-    parent_soup = BeautifulSoup(parent_sitemap_response.content, 'html.parser')
-
-    # Fetching all the href attribute values from every anchor element on the
-    # parent sitemap page, and storing the href values in a list
-    sitemap_parent_href_list = [link.get("href") for link in parent_soup.find_all("a")]
-    sitemap_children_href_list = []
-
-    # Fetching all the href attribute values from every anchor element on
-    # every child sitemap page, and storing the href values in a list
-    for href in sitemap_parent_href_list:
-        child_sitemap_response = requests.get(href)
-        child_soup = BeautifulSoup(child_sitemap_response.content, 'html.parser')
-        for a in child_soup.find_all('a'):
-            sitemap_children_href_list.append(a.get("href"))
-
-
-    # Only scrape the last 50 sitemap children web pages for testing purposes;
-    # set -50 to 0 in production environment
-    sitemap_children_href_list_sample = sitemap_children_href_list[-50:]
-
-    loop = asyncio.get_running_loop()
-
-    chunk_size = 5
-
-    scraped_web_pages_list = []
-
-    # Only process 5 at a time to avoid overloading memory
-    for i in range(0, len(sitemap_children_href_list_sample), chunk_size):
-        chunk = sitemap_children_href_list_sample[i:i + chunk_size]
-        tasks = [scrape_web_page_async(href, loop) for href in chunk]
-        scraped_web_pages_chunk_list = await asyncio.gather(*tasks)
-        scraped_web_pages_list.extend(scraped_web_pages_chunk_list)
-        print(f"Completed {i + chunk_size} of {len(sitemap_children_href_list_sample)} web pages.")
-
-    await upload_all_scraped_webpages(scraped_web_pages_list)
+    crawl_ledger = get_crawl_ledger()
+    run_id = crawl_ledger.begin_run()
+
+    # Resolve the ChromeDriver binary once before the workers start, and
+    # share one pool of drivers and one thread pool between all the workers
+    resolve_chrome_driver_path()
+    driver_pool = ChromeDriverPool(scraper_workers, page_load_timeout_seconds=scraper_page_timeout_seconds, checkout_timeout_seconds=scraper_attempt_max_seconds)
+    executor = ThreadPoolExecutor(max_workers=scraper_workers)
+
+    url_timeout_seconds = max(crawl_url_timeout_seconds, scraper_attempt_max_seconds + scraper_page_timeout_seconds)
+    if url_timeout_seconds > crawl_url_timeout_seconds:
+        print(f"SCRAPER_URL_TIMEOUT_SECONDS is raised to {url_timeout_seconds} seconds, to be longer than the page timeouts of one attempt.")
+    crawl_scheduler = CrawlScheduler(executor, url_timeout_seconds=url_timeout_seconds)
+
+    try:
+        await run_scrape_pipeline(iter_pending_sitemap_entries(crawl_ledger, run_id), driver_pool, crawl_scheduler, crawl_ledger, run_id)
+
+    finally:
+        executor.shutdown(wait=False)
+        driver_pool.close()
+
+    # Delete the vectors of the web pages that were removed from the sitemap
+    # (only known when the whole sitemap is crawled)
+    if scraper_url_limit == 0:
+        pc_vector_store = get_pdf_vector_store()
+        for url, vector_ids in crawl_ledger.pop_removed_entries(run_id):
+            print(f"Deleting the removed web page: {url}")
+            delete_texts(pc_vector_store, vector_ids)
+        persist_vector_store()
+
+    crawl_ledger.finish_run(run_id)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+import os
+from dotenv import load_dotenv
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# The DSpace search results are cached in memory for the TTL, with at most
+# max entries (the least recently used entries are evicted first)
+search_cache_enabled = os.getenv("SEARCH_CACHE_ENABLED", "true").lower() == "true"
+search_cache_ttl_seconds = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "300"))
+search_cache_max_entries = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "512"))
+
+# Optional shared cache (e.g. redis://localhost:6379/0), so that all the app
+# replicas benefit from each other's searches; requires the redis package,
+# which is an optional extra (pip3 install redis) not in requirements.txt
+search_cache_redis_url = os.getenv("SEARCH_CACHE_REDIS_URL", "")
+search_cache_redis_prefix = "fosrc:search:"
+
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+def normalize_search_query(search_query):
+    return " ".join((search_query or "").split()).lower()
+
+def get_search_signature(search_query, search_filters):
+
+    # The same search with the filters in a different order (or a differently
+    # spaced or capitalized query) has the same signature
+    return json.dumps([normalize_search_query(search_query), sorted(set(search_filters))], ensure_ascii=False)
+
+def get_search_cache_key(search_query, search_filters, size, page=0, sort="score,DESC"):
+    return json.dumps([get_search_signature(search_query, search_filters), str(size), page, sort], ensure_ascii=False)
+
+class SearchCache:
+
+    def __init__(self, ttl_seconds=search_cache_ttl_seconds, max_entries=search_cache_max_entries, redis_url=search_cache_redis_url):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.counters = {"hits": 0, "shared_hits": 0, "misses": 0}
+
+        self._redis = None
+        if redis_url:
+            if redis is None:
+                print("The redis package is not installed; the search cache is not shared.")
+            else:
+                self._redis = redis.Redis.from_url(redis_url, socket_timeout=1)
+
+    def _get_shared(self, key):
+        try:
+            value = self._redis.get(search_cache_redis_prefix + hashlib.sha256(key.encode("utf-8")).hexdigest())
+        except redis.RedisError as e:
+            print(f"Could not read the shared search cache: {e}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    def _set_shared(self, key, value):
+        try:
+            self._redis.set(search_cache_redis_prefix + hashlib.sha256(key.encode("utf-8")).hexdigest(), json.dumps(value), ex=max(1, int(self.ttl_seconds)))
+        except redis.RedisError as e:
+            print(f"Could not write the shared search cache: {e}")
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                cached_time, value = entry
+                if time.monotonic() - cached_time <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return value
+                del self._entries[key]
+
+        if self._redis is not None:
+            value = self._get_shared(key)
+            if value is not None:
+                self._set_local(key, value)
+                with self._lock:
+                    self.counters["shared_hits"] += 1
+                return value
+
+        with self._lock:
+            self.counters["misses"] += 1
+        return None
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        if self._redis is not None:
+            self._set_shared(key, value)
+
+    def get_or_search(self, dspace_client, search_query, search_filters, size, page=0, sort="score,DESC"):
+
+        # Returns the cached searchResult of the search, or runs the search
+        # with the DSpace client and caches its searchResult
+        key = get_search_cache_key(search_query, search_filters, size, page, sort)
+
+        search_result = self.get(key)
+        if search_result is None:
+            search_result = dspace_client.search(search_query, search_filters, size=size, page=page, sort=sort)
+            self.set(key, search_result)
+
+        return search_result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            lookups = sum(self.counters.values())
+            return {
+                **self.counters,
+                "entries": len(self._entries),
+                "hit_rate": (self.counters["hits"] + self.counters["shared_hits"]) / lookups if lookups else 0.0,
+            }
+
+def get_search_cache():
+    global _search_cache
+
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SearchCache(
+                ttl_seconds=search_cache_ttl_seconds if search_cache_enabled else 0,
+                max_entries=search_cache_max_entries if search_cache_enabled else 0,
+                redis_url=search_cache_redis_url if search_cache_enabled else ""
+            )
+        return _search_cache
+
+def get_search_cache_stats():
+    return get_search_cache().get_stats()
@@ -0,0 +1,122 @@
+import httpx
+from dspace_client import AsyncDSpaceClient
+from bs4 import BeautifulSoup
+from xml.etree.ElementTree import XMLPullParser
+import asyncio
+import os
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# Number of child sitemaps fetched at the same time over the pooled
+# keep-alive connections, and the timeout of every sitemap request
+sitemap_fetch_concurrency = int(os.getenv("SITEMAP_FETCH_CONCURRENCY", "8"))
+sitemap_timeout_seconds = float(os.getenv("SITEMAP_TIMEOUT_SECONDS", "30"))
+
+# Maximum number of discovered URLs waiting to be consumed
+sitemap_queue_size = 1000
+
+def _local_name(tag):
+
+    # Strips the XML namespace ("{http://www.sitemaps.org/...}loc" -> "loc")
+    return tag.rsplit("}", 1)[-1]
+
+async def iter_xml_sitemap(dspace_client, sitemap_url):
+
+    # Streams the sitemap and parses it incrementally, yielding the
+    # ("url" or "sitemap", location, lastmod) entries as soon as they are
+    # parsed; the parsed elements are cleared so that memory stays constant
+    parser = XMLPullParser(events=("end",))
+
+    async with dspace_client.stream(sitemap_url) as response:
+        response.raise_for_status()
+
+        async for data in response.aiter_bytes():
+            parser.feed(data)
+
+            for _, element in parser.read_events():
+                entry_type = _local_name(element.tag)
+                if entry_type not in ("url", "sitemap"):
+                    continue
+
+                location = None
+                lastmod = None
+                for child in element:
+                    if _local_name(child.tag) == "loc":
+                        location = (child.text or "").strip()
+                    elif _local_name(child.tag) == "lastmod":
+                        lastmod = (child.text or "").strip() or None
+                element.clear()
+
+                if location:
+                    yield entry_type, location, lastmod
+
+    parser.close()
+
+async def get_html_sitemap_links(dspace_client, sitemap_url):
+
+    # Fallback for HTML sitemaps, which have no lastmod
+    response = await dspace_client.get(sitemap_url)
+    response.raise_for_status()
+
+    soup = BeautifulSoup(response.content, 'html.parser')
+
+    return [link.get("href") for link in soup.find_all("a") if link.get("href")]
+
+async def get_sitemap_index(dspace_client):
+
+    # Returns the child sitemaps of the XML sitemap index, or of the HTML
+    # sitemap index when the XML one is not available
+    try:
+        child_sitemap_urls = [location async for entry_type, location, _ in iter_xml_sitemap(dspace_client, "/sitemap_index.xml") if entry_type == "sitemap"]
+        if child_sitemap_urls:
+            return child_sitemap_urls, True
+    except (httpx.HTTPError, SyntaxError) as e:
+        print(f"XML sitemap index unavailable, falling back to the HTML sitemap index: {e}")
+
+    return await get_html_sitemap_links(dspace_client, "/sitemap_index.html"), False
+
+async def iter_sitemap_urls(server_link):
+
+    # Yields the (url, lastmod) of every web page in the sitemap as a stream;
+    # the child sitemaps are fetched concurrently over one pool of
+    # keep-alive connections, and their URLs are yielded while the other
+    # child sitemaps are still being fetched
+    async with AsyncDSpaceClient(server_link, max_connections=sitemap_fetch_concurrency, timeout_seconds=sitemap_timeout_seconds) as dspace_client:
+        child_sitemap_urls, is_xml = await get_sitemap_index(dspace_client)
+
+        url_queue = asyncio.Queue(maxsize=sitemap_queue_size)
+        semaphore = asyncio.Semaphore(sitemap_fetch_concurrency)
+
+        async def fetch_child_sitemap(child_sitemap_url):
+            async with semaphore:
+                if is_xml:
+                    async for entry_type, location, lastmod in iter_xml_sitemap(dspace_client, child_sitemap_url):
+                        if entry_type == "url":
+                            await url_queue.put((location, lastmod))
+                else:
+                    for href in await get_html_sitemap_links(dspace_client, child_sitemap_url):
+                        await url_queue.put((href, None))
+
+        async def fetch_all_child_sitemaps():
+
+            # A failed child sitemap stops the walk, since an incomplete list
+            # of URLs would make the missing web pages look removed
+            try:
+                await asyncio.gather(*[fetch_child_sitemap(child_sitemap_url) for child_sitemap_url in child_sitemap_urls])
+            except Exception as e:
+                await url_queue.put(e)
+                return
+            await url_queue.put(None)
+
+        fetch_task = asyncio.create_task(fetch_all_child_sitemaps())
+
+        try:
+            while (entry := await url_queue.get()) is not None:
+                if isinstance(entry, Exception):
+                    raise entry
+                yield entry
+
+        finally:
+            fetch_task.cancel()
@@ -0,0 +1,302 @@
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from collections import Counter
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+import os
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+# The sparse index of the ingested chunks used for BM25 keyword search; it
+# is built by the PDF upload and the scraper alongside the vectors; with the
+# Pinecone backend, it is a Pinecone sparse index shared by every replica,
+# and with the local backends, a SQLite inverted index (so the path must be
+# shared with the app)
+sparse_index_enabled = os.getenv("SPARSE_INDEX_ENABLED", "true").lower() == "true"
+sparse_index_backend = os.getenv("VECTOR_STORE_BACKEND", "pinecone").lower()
+sparse_index_path = os.getenv("SPARSE_INDEX_PATH", os.path.join(".cache", "sparse_index.sqlite3"))
+
+# The Pinecone sparse vectors carry the BM25 weight of every term in the
+# chunk; since the shared index keeps no corpus statistics, the document
+# length is normalized by this typical chunk length (in terms), and the
+# query terms are weighted equally instead of by their inverse document
+# frequency
+sparse_index_average_length = float(os.getenv("SPARSE_INDEX_AVERAGE_LENGTH", "150"))
+
+# Maximum number of IDs per Pinecone fetch and delete request
+pinecone_fetch_batch_size = 100
+pinecone_delete_batch_size = 1000
+
+# BM25 term frequency saturation and document length normalization
+bm25_k1 = 1.5
+bm25_b = 0.75
+
+# Rank constant of the reciprocal rank fusion
+rrf_k = 60
+
+# Terms are words, acronyms and identifiers such as report numbers
+# ("2023/045", "CSAS-2021-12"), lowercased
+term_pattern = re.compile(r"\w+(?:[-./]\w+)*")
+
+stop_words = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "in", "is", "it", "its", "of", "on", "or", "that", "the", "this", "to", "was", "were", "with",
+    "au", "aux", "avec", "ce", "ces", "dans", "de", "des", "du", "en", "est", "et", "la", "le", "les", "par", "pour", "qui", "sur", "un", "une",
+}
+
+_sparse_index = None
+_sparse_index_lock = threading.Lock()
+
+def tokenize(text):
+    return [term for term in term_pattern.findall(text.lower()) if term not in stop_words]
+
+class SparseIndex:
+
+    def __init__(self, index_path):
+        self._lock = threading.Lock()
+
+        # Document count and average length, kept until the index changes
+        # (in this process, or in another one such as the scraper)
+        self._statistics = None
+        self._statistics_version = None
+
+        os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+
+        self._connection = sqlite3.connect(index_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, text TEXT NOT NULL, metadata TEXT NOT NULL, length INTEGER NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, id TEXT NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, id)) WITHOUT ROWID")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+        self._connection.commit()
+
+    def get_existing_ids(self, ids):
+        existing_ids = set()
+        ids = list(ids)
+
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                ids_batch = ids[i:i + 500]
+                rows = self._connection.execute(
+                    f"SELECT id FROM documents WHERE id IN ({','.join('?' * len(ids_batch))})",
+                    ids_batch
+                ).fetchall()
+                existing_ids.update(id for id, in rows)
+
+        return existing_ids
+
+    def add_documents(self, ids, texts, metadatas):
+
+        # Indexes the chunks that are not indexed yet
+        existing_ids = self.get_existing_ids(ids)
+
+        documents = []
+        postings = []
+        for id, text, metadata in zip(ids, texts, metadatas):
+            if id in existing_ids:
+                continue
+            existing_ids.add(id)
+
+            term_counts = Counter(tokenize(text))
+            documents.append((id, text, json.dumps(metadata), sum(term_counts.values())))
+            postings.extend((term, id, tf) for term, tf in term_counts.items())
+
+        if not documents:
+            return
+
+        with self._lock:
+            self._connection.executemany("INSERT OR IGNORE INTO documents (id, text, metadata, length) VALUES (?, ?, ?, ?)", documents)
+            self._connection.executemany("INSERT OR IGNORE INTO postings (term, id, tf) VALUES (?, ?, ?)", postings)
+            self._connection.commit()
+            self._statistics = None
+
+    def delete(self, ids):
+        with self._lock:
+            self._connection.executemany("DELETE FROM postings WHERE id = ?", [(id,) for id in ids])
+            self._connection.executemany("DELETE FROM documents WHERE id = ?", [(id,) for id in ids])
+            self._connection.commit()
+            self._statistics = None
+
+    def _get_statistics(self):
+
+        # PRAGMA data_version changes when another connection commits
+        data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+        if self._statistics is None or data_version != self._statistics_version:
+            self._statistics = self._connection.execute("SELECT COUNT(*), AVG(length) FROM documents").fetchone()
+            self._statistics_version = data_version
+        return self._statistics
+
+    def search(self, query, k=10):
+
+        # Returns the k best matching chunks by BM25 score; the scores are
+        # summed and ranked in SQLite, so only the top k rows are returned
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            document_count, average_length = self._get_statistics()
+            if not document_count:
+                return []
+            average_length = average_length or 1
+
+            # The document frequency of every term, counted on the postings
+            # primary key
+            document_frequencies = self._connection.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({','.join('?' * len(terms))}) GROUP BY term",
+                terms
+            ).fetchall()
+            if not document_frequencies:
+                return []
+
+            query_terms = []
+            for term, document_frequency in document_frequencies:
+                inverse_document_frequency = math.log(1 + (document_count - document_frequency + 0.5) / (document_frequency + 0.5))
+                query_terms.extend((term, inverse_document_frequency))
+
+            rows = self._connection.execute(
+                f"WITH query_terms (term, idf) AS (VALUES {','.join(['(?, ?)'] * len(document_frequencies))}) "
+                "SELECT documents.id, documents.text, documents.metadata, "
+                "SUM(query_terms.idf * postings.tf * (? + 1) / (postings.tf + ? * (1 - ? + ? * documents.length / ?))) AS score "
+                "FROM query_terms JOIN postings ON postings.term = query_terms.term JOIN documents ON documents.id = postings.id "
+                "GROUP BY documents.id ORDER BY score DESC LIMIT ?",
+                query_terms + [bm25_k1, bm25_k1, bm25_b, bm25_b, float(average_length), k]
+            ).fetchall()
+
+        return [Document(id=id, page_content=text, metadata=json.loads(metadata)) for id, text, metadata, _ in rows]
+
+def get_term_index(term):
+
+    # Pinecone sparse vector indices are 32-bit integers, so every term is
+    # hashed to one
+    return int.from_bytes(hashlib.sha256(term.encode("utf-8")).digest()[:4], "big")
+
+def get_sparse_values(term_weights):
+
+    # Sums the weights of the terms that hash to the same index, since
+    # Pinecone rejects duplicate indices
+    weights_by_index = Counter()
+    for term, weight in term_weights.items():
+        weights_by_index[get_term_index(term)] += weight
+
+    indices = sorted(weights_by_index)
+    return {"indices": indices, "values": [float(weights_by_index[index]) for index in indices]}
+
+class PineconeSparseIndex:
+
+    # BM25 keyword search on a Pinecone sparse index, so that every replica
+    # of the app, the PDF upload and the scraper share the same keyword index
+    # as the dense Pinecone index; the chunk text and metadata are stored
+    # in the vector metadata, as in the dense index
+
+    def __init__(self, index):
+        self.index = index
+
+    def get_existing_ids(self, ids):
+        existing_ids = set()
+        ids = list(ids)
+
+        for i in range(0, len(ids), pinecone_fetch_batch_size):
+            fetch_response = self.index.fetch(ids=ids[i:i + pinecone_fetch_batch_size])
+            existing_ids.update(fetch_response.vectors.keys())
+
+        return existing_ids
+
+    def add_documents(self, ids, texts, metadatas):
+
+        # Indexes the chunks that are not indexed yet, with the BM25 term
+        # frequency saturation and length normalization of every term
+        existing_ids = self.get_existing_ids(ids)
+
+        vectors = []
+        for id, text, metadata in zip(ids, texts, metadatas):
+            if id in existing_ids:
+                continue
+            existing_ids.add(id)
+
+            term_counts = Counter(tokenize(text))
+            if not term_counts:
+                continue
+
+            length_norm = 1 - bm25_b + bm25_b * sum(term_counts.values()) / sparse_index_average_length
+            term_weights = {term: tf * (bm25_k1 + 1) / (tf + bm25_k1 * length_norm) for term, tf in term_counts.items()}
+            vectors.append({"id": id, "sparse_values": get_sparse_values(term_weights), "metadata": {**metadata, "text": text}})
+
+        for i in range(0, len(vectors), pinecone_fetch_batch_size):
+            self.index.upsert(vectors=vectors[i:i + pinecone_fetch_batch_size])
+
+    def delete(self, ids):
+        ids = list(ids)
+        for i in range(0, len(ids), pinecone_delete_batch_size):
+            self.index.delete(ids=ids[i:i + pinecone_delete_batch_size])
+
+    def search(self, query, k=10):
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        query_response = self.index.query(
+            sparse_vector=get_sparse_values({term: 1 for term in terms}),
+            top_k=k,
+            include_metadata=True
+        )
+
+        documents = []
+        for match in query_response.matches:
+            metadata = dict(match.metadata or {})
+            text = metadata.pop("text", None)
+            if text is None:
+                continue
+            documents.append(Document(id=match.id, page_content=text, metadata=metadata))
+
+        return documents
+
+def get_sparse_index():
+    global _sparse_index
+
+    with _sparse_index_lock:
+        if _sparse_index is None:
+            if sparse_index_backend == "pinecone":
+                # Imported here since the vector_store module imports this one
+                from vector_store import get_pinecone_sparse_index
+
+                _sparse_index = PineconeSparseIndex(get_pinecone_sparse_index())
+            else:
+                _sparse_index = SparseIndex(sparse_index_path)
+        return _sparse_index
+
+def reciprocal_rank_fusion(rankings, k):
+
+    # Fuses several ranked lists of documents into one ranking, scoring
+    # every document by the sum of 1 / (rrf_k + rank) over the lists
+    scores = Counter()
+    documents_by_key = {}
+
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = document.id or document.page_content
+            scores[key] += 1 / (rrf_k + rank)
+            documents_by_key.setdefault(key, document)
+
+    return [documents_by_key[key] for key, _ in scores.most_common(k)]
+
+class HybridRetriever(BaseRetriever):
+
+    # Fuses the dense (vector) retriever ranking with the BM25 ranking of the
+    # sparse index, so that exact terms such as species names, acronyms and
+    # report numbers are found even when the dense retrieval misses them
+
+    dense_retriever: BaseRetriever
+    sparse_index: object
+    k: int = 4
+    sparse_k: int = 10
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        dense_documents = self.dense_retriever.invoke(query)
+        sparse_documents = self.sparse_index.search(query, k=self.sparse_k)
+
+        return reciprocal_rank_fusion([dense_documents, sparse_documents], self.k)
@@ -1,20 +1,108 @@
-from pypdf import PdfReader
+from langchain_core.messages import SystemMessage
+from pdf_text import get_pdf_text
+from chunking import count_tokens, split_text_by_tokens
+import os
+from dotenv import load_dotenv
 
-def generate_pdf_summary_prompt(pdf_file, language):
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
 
-    pdf_reader = PdfReader(pdf_file)
+# Documents with more tokens than the max prompt tokens are summarized with
+# map-reduce: the text is split into chunks of the chunk tokens size, the
+# chunks are summarized concurrently (at most max concurrency at a time),
+# and the partial summaries are then combined into the final summary
+summary_max_prompt_tokens = int(os.getenv("SUMMARY_MAX_PROMPT_TOKENS", "16000"))
+summary_chunk_tokens = int(os.getenv("SUMMARY_CHUNK_TOKENS", "8000"))
+summary_max_concurrency = int(os.getenv("SUMMARY_MAX_CONCURRENCY", "8"))
 
-    full_pdf_text = ""
-
-    # Iterate through all the PDF pages and remove all the new 
-    # line characters to save tokens
-    for i in range(len(pdf_reader.pages)):
-        full_pdf_text += ' '.join(pdf_reader.pages[i].extract_text().split())
+def build_summary_prompt(text, language):
 
     summary_prompt = f'''
 You are a scientific expert that can communicate simply, clearly, and concisely.  Provide a detailed summary of the following text in layman's terms in {language}:
-{full_pdf_text}
+{text}
 '''
 
     return summary_prompt
 
+def build_partial_summary_prompt(text, language):
+
+    partial_summary_prompt = f'''
+You are a scientific expert that can communicate simply, clearly, and concisely.  The following text is one section of a longer document.  Summarize the key findings, methods, figures, and conclusions of this section in {language}, and only output the summary:
+{text}
+'''
+
+    return partial_summary_prompt
+
+def build_combined_summary_prompt(partial_summaries, language):
+
+    joined_partial_summaries = "\n\n".join(partial_summaries)
+
+    combined_summary_prompt = f'''
+You are a scientific expert that can communicate simply, clearly, and concisely.  The following are summaries of consecutive sections of one document.  Combine them into a single detailed summary of the whole document in layman's terms in {language}:
+{joined_partial_summaries}
+'''
+
+    return combined_summary_prompt
+
+def _summarize_concurrently(client, prompts):
+    responses = client.batch(
+        [[SystemMessage(prompt)] for prompt in prompts],
+        config={"max_concurrency": summary_max_concurrency}
+    )
+
+    return [response.content for response in responses]
+
+def _group_partial_summaries(partial_summaries):
+
+    # Groups consecutive partial summaries so that each group fits in
+    # one chunk; every group (except the last one) holds at least two
+    # partial summaries, so that every reduce round about halves the count,
+    # and longer partial summaries are truncated so that two fit in a chunk
+    partial_summary_max_tokens = max(1, summary_chunk_tokens // 2)
+
+    groups = []
+    current_group = []
+    current_group_tokens = 0
+
+    for partial_summary in partial_summaries:
+        partial_summary_tokens = count_tokens(partial_summary)
+        if partial_summary_tokens > partial_summary_max_tokens:
+            partial_summary = split_text_by_tokens(partial_summary, partial_summary_max_tokens)[0]
+            partial_summary_tokens = partial_summary_max_tokens
+        if len(current_group) >= 2 and current_group_tokens + partial_summary_tokens > summary_chunk_tokens:
+            groups.append(current_group)
+            current_group = []
+            current_group_tokens = 0
+        current_group.append(partial_summary)
+        current_group_tokens += partial_summary_tokens
+
+    if current_group:
+        groups.append(current_group)
+
+    return groups
+
+def stream_pdf_summary(pdf_file, language, client):
+
+    # Yields the summary of the PDF as it streams from the model
+    full_pdf_text = get_pdf_text(pdf_file)
+
+    # Short documents are summarized with a single prompt
+    if count_tokens(full_pdf_text) <= summary_max_prompt_tokens:
+        yield from client.stream([SystemMessage(build_summary_prompt(full_pdf_text, language))])
+        return
+
+    # Map: summarize every chunk of the document concurrently
+    partial_summaries = _summarize_concurrently(
+        client,
+        [build_partial_summary_prompt(text, language) for text in split_text_by_tokens(full_pdf_text, summary_chunk_tokens)]
+    )
+
+    # Reduce: combine groups of partial summaries concurrently until all of
+    # them fit in a single prompt
+    while len(partial_summaries) > 1 and count_tokens("\n\n".join(partial_summaries)) > summary_max_prompt_tokens:
+        partial_summaries = _summarize_concurrently(
+            client,
+            [build_combined_summary_prompt(group, language) for group in _group_partial_summaries(partial_summaries)]
+        )
+
+    yield from client.stream([SystemMessage(build_combined_summary_prompt(partial_summaries, language))])
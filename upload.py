@@ -1,68 +1,95 @@
-from pinecone import Pinecone, ServerlessSpec
-from langchain_text_splitters.character import CharacterTextSplitter
-from langchain_openai.embeddings import OpenAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
-import time
+import asyncio
 # import streamlit as st
-from pypdf import PdfReader
+from pdf_text import iter_pdf_pages, read_pdf_bytes, get_pdf_hash
+from chunking import iter_token_chunks, iter_batches
+from citation import agenerate_pdf_citation
+from vector_store import add_new_texts, delete_stale_source_texts, get_pdf_vector_store, persist_vector_store
 import os
 from dotenv import load_dotenv
 
 if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
     load_dotenv()
 
-openai_api_key = os.getenv("OPENAI_API_KEY")
-pinecone_api_key = os.getenv("PINECONE_API_KEY")
-
-def upload_pdf(pdf_file, citation):
-
-    pc = Pinecone(api_key=pinecone_api_key)
-
-    index_name = "pdf-index"
-
-    if not pc.has_index(index_name):
-        pc.create_index(
-            name=index_name,
-            # Dimension has been set to 1536 to match OpenAI's "text-embedding-3-small" embedding algorithm
-            dimension=1536,
-            metric="cosine",
-            spec=ServerlessSpec(
-                cloud='aws',
-                region='us-east-1'
-            )
-        )
-        while not pc.describe_index(index_name).status["ready"]:
-            time.sleep(1)
-
-    pdf_reader = PdfReader(pdf_file)
-
-    full_pdf_text = ""
-
-    # Iterate through all the PDF pages and remove all the new 
-    # line characters to save tokens
-    for i in range(len(pdf_reader.pages)):
-        full_pdf_text += ' '.join(pdf_reader.pages[i].extract_text().split())
-
-    # Initializing the character splitter, and defining how you want
-    #  split text up in a document
-    char_splitter = CharacterTextSplitter(
-        # Setting the separator to "." to separate at the end of a sentence, and
-        # to not end the chunk before a sentence finishes
-        separator = ".",
-        chunk_size = 1000,
-        chunk_overlap  = 20
+# Number of chunks embedded and upserted to the vector database at a time
+upload_batch_size = int(os.getenv("UPLOAD_BATCH_SIZE", "100"))
+
+# Maximum number of PDF files that are cited, extracted, embedded and
+# upserted at the same time by upload_pdfs
+upload_max_concurrency = int(os.getenv("UPLOAD_MAX_CONCURRENCY", "4"))
+
+def iter_pdf_chunk_batches(pdf_file, source_type="pdf", use_cache=True):
+
+    # Stream the PDF pages (with the new line characters removed to
+    # save tokens) into the chunker, and split the text up into chunks of
+    # whole sentences within the token budget of the source type as the
+    # pages arrive; the pages are separated by a space, so that the last
+    # sentence of a page ends before the first word of the next page
+    char_split_text = iter_token_chunks(
+        (page_text + " " for page_text in iter_pdf_pages(pdf_file, use_cache=use_cache)),
+        source_type
     )
 
-    # Splitting the original PDF file into chunks of text
-    char_split_text = char_splitter.split_text(full_pdf_text)
+    # Group the chunks into fixed-size batches, so that memory use
+    # does not grow with the length of the document
+    return iter_batches(char_split_text, upload_batch_size)
+
+async def aupload_pdf(pdf_file, citation, pc_vector_store):
+
+    # The vector IDs are derived from the PDF content hash, so uploading
+    # the same PDF again does not embed or store its chunks a second time
+    pdf_hash = get_pdf_hash(read_pdf_bytes(pdf_file))
+
+    char_split_text_batches = iter_pdf_chunk_batches(pdf_file)
+
+    # The extraction, embedding and upsert of every batch run in worker
+    # threads, so that the batches of other files proceed in the meantime;
+    # the synchronous add_texts is used because the asynchronous Pinecone
+    # index is closed after every aadd_texts call
+    ids = []
+    while char_split_text_batch := await asyncio.to_thread(next, char_split_text_batches, None):
+        ids.extend(await asyncio.to_thread(
+            add_new_texts,
+            pc_vector_store,
+            texts=char_split_text_batch,
+            metadatas=[{"citation": citation} for _ in range(len(char_split_text_batch))],
+            source_id=pdf_hash
+        ))
+
+    await asyncio.to_thread(delete_stale_source_texts, pc_vector_store, pdf_hash, ids)
+
+async def upload_pdfs(pdf_files, client, max_concurrency=None, on_progress=None):
+
+    # Cites and uploads the PDF files concurrently, with at most max_concurrency
+    # files in flight; on_progress(pdf_file, status, error) is called when a
+    # file starts citing ("citing"), starts uploading ("uploading"), finishes
+    # ("done"), or fails ("failed"), and the number of failed files is returned
+    semaphore = asyncio.Semaphore(max_concurrency or upload_max_concurrency)
+
+    pc_vector_store = await asyncio.to_thread(get_pdf_vector_store)
+
+    def report_progress(pdf_file, status, error=None):
+        if on_progress is not None:
+            on_progress(pdf_file, status, error)
+
+    async def upload_one(pdf_file):
+        async with semaphore:
+            try:
+                report_progress(pdf_file, "citing")
+                citation = await agenerate_pdf_citation(pdf_file, "APA", client)
+
+                report_progress(pdf_file, "uploading")
+                await aupload_pdf(pdf_file, citation, pc_vector_store)
+
+                report_progress(pdf_file, "done")
+                return True
 
-    embedding = OpenAIEmbeddings(model = "text-embedding-3-small", openai_api_key=openai_api_key)
+            except Exception as e:
+                print(f"Upload failed for {getattr(pdf_file, 'name', pdf_file)}: {e}")
+                report_progress(pdf_file, "failed", e)
+                return False
 
-    index = pc.Index(index_name)
+    results = await asyncio.gather(*[upload_one(pdf_file) for pdf_file in pdf_files])
 
-    pc_vector_store = PineconeVectorStore(index=index, embedding=embedding)
+    await asyncio.to_thread(persist_vector_store)
 
-    pc_vector_store.add_texts(
-        texts=char_split_text,
-        metadatas=[{"citation": citation} for _ in range(len(char_split_text))]
-    )
\ No newline at end of file
+    return results.count(False)
@@ -0,0 +1,247 @@
+from pinecone import Pinecone, ServerlessSpec
+from langchain_pinecone import PineconeVectorStore
+from embeddings_cache import get_embeddings
+from local_vector_store import NumpyVectorStore, HnswVectorStore
+from sparse_index import get_sparse_index, sparse_index_enabled
+from mmr import clear_result_cache
+from chunking import iter_batches
+import hashlib
+import threading
+import time
+import os
+from dotenv import load_dotenv
+
+if os.getenv("DEPLOYMENT_ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+pinecone_api_key = os.getenv("PINECONE_API_KEY")
+
+# The vector store backend: "pinecone" (the hosted index), "numpy" (a local
+# exact search store) or "hnsw" (a local approximate nearest neighbour
+# index, which requires the hnswlib package); local stores are persisted
+# in the local vector store directory
+vector_store_backend = os.getenv("VECTOR_STORE_BACKEND", "pinecone").lower()
+local_vector_store_dir = os.getenv("LOCAL_VECTOR_STORE_DIR", os.path.join(".cache", "vector_store"))
+
+# Number of threads (and pooled connections) used by the shared Pinecone index
+pinecone_pool_threads = int(os.getenv("PINECONE_POOL_THREADS", "8"))
+
+index_name = "pdf-index"
+
+# The Pinecone sparse index of the BM25 keyword search (see sparse_index.py)
+sparse_index_name = "pdf-index-sparse"
+
+# Maximum number of vector IDs looked up per Pinecone fetch request
+fetch_batch_size = 100
+
+# Maximum number of vector IDs per Pinecone delete request
+delete_batch_size = 1000
+
+# The Pinecone client, index and vector store are created once per process
+# on first use, and shared by the RAG chain, the PDF upload and the scraper
+_registry_lock = threading.Lock()
+_pinecone_client = None
+_pinecone_index = None
+_pinecone_sparse_index = None
+_pdf_vector_store = None
+
+def get_pinecone_client():
+    global _pinecone_client
+
+    with _registry_lock:
+        if _pinecone_client is None:
+            _pinecone_client = Pinecone(api_key=pinecone_api_key, pool_threads=pinecone_pool_threads)
+        return _pinecone_client
+
+def get_pinecone_index():
+    global _pinecone_index
+
+    pc = get_pinecone_client()
+
+    with _registry_lock:
+        if _pinecone_index is None:
+
+            # The index is provisioned (and checked for readiness) only
+            # once per process instead of on every call
+            if not pc.has_index(index_name):
+                pc.create_index(
+                    name=index_name,
+                    # Dimension has been set to 1536 to match OpenAI's "text-embedding-3-small" embedding algorithm
+                    dimension=1536,
+                    metric="cosine",
+                    spec=ServerlessSpec(
+                        cloud='aws',
+                        region='us-east-1'
+                    )
+                )
+                while not pc.describe_index(index_name).status["ready"]:
+                    time.sleep(1)
+
+            _pinecone_index = pc.Index(
+                index_name,
+                pool_threads=pinecone_pool_threads,
+                connection_pool_maxsize=pinecone_pool_threads
+            )
+
+        return _pinecone_index
+
+def get_pinecone_sparse_index():
+    global _pinecone_sparse_index
+
+    pc = get_pinecone_client()
+
+    with _registry_lock:
+        if _pinecone_sparse_index is None:
+            if not pc.has_index(sparse_index_name):
+                pc.create_index(
+                    name=sparse_index_name,
+                    # Sparse indexes only support the dot product metric
+                    metric="dotproduct",
+                    vector_type="sparse",
+                    spec=ServerlessSpec(
+                        cloud='aws',
+                        region='us-east-1'
+                    )
+                )
+                while not pc.describe_index(sparse_index_name).status["ready"]:
+                    time.sleep(1)
+
+            _pinecone_sparse_index = pc.Index(
+                sparse_index_name,
+                pool_threads=pinecone_pool_threads,
+                connection_pool_maxsize=pinecone_pool_threads
+            )
+
+        return _pinecone_sparse_index
+
+def get_pdf_vector_store():
+    global _pdf_vector_store
+
+    if vector_store_backend == "numpy":
+        with _registry_lock:
+            if _pdf_vector_store is None:
+                _pdf_vector_store = NumpyVectorStore(get_embeddings(), os.path.join(local_vector_store_dir, index_name))
+            return _pdf_vector_store
+
+    if vector_store_backend == "hnsw":
+        with _registry_lock:
+            if _pdf_vector_store is None:
+                _pdf_vector_store = HnswVectorStore(get_embeddings(), os.path.join(local_vector_store_dir, index_name + "-hnsw"))
+            return _pdf_vector_store
+
+    if vector_store_backend != "pinecone":
+        raise ValueError(f"Unknown VECTOR_STORE_BACKEND: {vector_store_backend}")
+
+    index = get_pinecone_index()
+
+    with _registry_lock:
+        if _pdf_vector_store is None:
+            _pdf_vector_store = PineconeVectorStore(index=index, embedding=get_embeddings())
+        return _pdf_vector_store
+
+def persist_vector_store():
+
+    # Saves the approximate nearest neighbour graph of the hnsw backend;
+    # the other backends persist every write as it happens
+    if _pdf_vector_store is not None and hasattr(_pdf_vector_store, "persist"):
+        _pdf_vector_store.persist()
+
+def get_source_id_prefix(source_id):
+
+    # Every vector ID starts with a short hash of its source, so that all
+    # the vectors of a source can be listed by ID prefix
+    return hashlib.sha256(source_id.encode("utf-8")).hexdigest()[:16] + "-"
+
+def get_chunk_id(source_id, text):
+
+    # Vector IDs are derived from the source (the PDF content hash or the web
+    # page URL) and the chunk text, so re-ingesting unchanged text produces
+    # the same IDs instead of duplicate vectors
+    return get_source_id_prefix(source_id) + hashlib.sha256(f"{source_id}\n{text}".encode("utf-8")).hexdigest()
+
+def fetch_existing_ids(pc_vector_store, ids):
+
+    # Returns the subset of the IDs that are already stored in the index
+    if isinstance(pc_vector_store, NumpyVectorStore):
+        return pc_vector_store.get_existing_ids(ids)
+
+    existing_ids = set()
+
+    for ids_batch in iter_batches(ids, fetch_batch_size):
+        fetch_response = pc_vector_store.index.fetch(ids=ids_batch)
+        existing_ids.update(fetch_response.vectors.keys())
+
+    return existing_ids
+
+def add_new_texts(pc_vector_store, texts, metadatas, source_id):
+
+    # Adds the chunks whose IDs are not yet in the index, and skips
+    # the rest so that unchanged chunks are never embedded again;
+    # returns the IDs of all the chunks (new and existing)
+    new_chunks = {}
+    ids = []
+
+    for text, metadata in zip(texts, metadatas):
+        chunk_id = get_chunk_id(source_id, text)
+        ids.append(chunk_id)
+        if chunk_id not in new_chunks:
+            new_chunks[chunk_id] = (text, metadata)
+
+    # The chunks are also added to the BM25 sparse index for hybrid search
+    # (before add_texts, which adds the text to the metadata dictionaries)
+    if sparse_index_enabled:
+        get_sparse_index().add_documents(
+            list(new_chunks),
+            [text for text, _ in new_chunks.values()],
+            [dict(metadata) for _, metadata in new_chunks.values()]
+        )
+
+    for existing_id in fetch_existing_ids(pc_vector_store, list(new_chunks)):
+        del new_chunks[existing_id]
+
+    if new_chunks:
+        pc_vector_store.add_texts(
+            texts=[text for text, _ in new_chunks.values()],
+            metadatas=[metadata for _, metadata in new_chunks.values()],
+            ids=list(new_chunks)
+        )
+        clear_result_cache()
+
+    return ids
+
+def list_source_ids(pc_vector_store, source_id):
+
+    # Returns the IDs of all the stored chunks of the source
+    prefix = get_source_id_prefix(source_id)
+
+    if isinstance(pc_vector_store, NumpyVectorStore):
+        return pc_vector_store.get_ids_with_prefix(prefix)
+
+    source_ids = set()
+    for ids_page in pc_vector_store.index.list(prefix=prefix):
+        source_ids.update(ids_page)
+
+    return source_ids
+
+def delete_stale_source_texts(pc_vector_store, source_id, ids):
+
+    # Deletes the stored chunks of the source that are not among the IDs of
+    # its latest ingestion (e.g. after the chunk settings have changed), so
+    # that re-ingesting a source does not leave its previous chunks behind
+    ids = set(ids)
+    delete_texts(pc_vector_store, [id for id in list_source_ids(pc_vector_store, source_id) if id not in ids])
+
+def delete_texts(pc_vector_store, ids):
+
+    # Deletes the chunks from the index and from the BM25 sparse index
+    ids = list(ids)
+    if not ids:
+        return
+
+    for ids_batch in iter_batches(ids, delete_batch_size):
+        pc_vector_store.delete(ids=ids_batch)
+
+    if sparse_index_enabled:
+        get_sparse_index().delete(ids)
+
+    clear_result_cache()